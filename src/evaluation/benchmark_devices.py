@@ -0,0 +1,67 @@
+import multiprocessing
+import os
+import statistics
+import time
+
+import click
+import torch
+
+from evaluation.corpora.red_fm import RedFM
+from waka.nlp.kg import KnowledgeGraph
+from waka.nlp.kg_construction import KGConstructor
+
+CONFIGURATIONS = {
+    "cuda": {"WAKA_DEVICE": "cuda", "WAKA_QUANTIZE": "0"},
+    "cpu": {"WAKA_DEVICE": "cpu", "WAKA_QUANTIZE": "0"},
+    "cpu-int8": {"WAKA_DEVICE": "cpu", "WAKA_QUANTIZE": "1"},
+}
+
+
+@click.command()
+@click.option("-c", "--configuration", type=click.Choice(list(CONFIGURATIONS.keys())), multiple=True,
+              default=list(CONFIGURATIONS.keys()))
+@click.option("-n", "--num-texts", type=int, default=100)
+def main(configuration, num_texts):
+    multiprocessing.set_start_method("spawn")
+    results = {}
+
+    for name in configuration:
+        if name == "cuda" and not torch.cuda.is_available():
+            print(f"Skip {name}, CUDA is not available")
+            continue
+
+        # The pipeline workers are spawned after this, so they inherit the device configuration.
+        os.environ.update(CONFIGURATIONS[name])
+        kg_construct = KGConstructor()
+        kg_construct.wait_ready()
+
+        dataset = RedFM()
+        latencies = []
+        desired_triples = []
+        computed_triples = []
+
+        while dataset.has_next() and len(latencies) < num_texts:
+            kg = dataset.next()
+            start = time.perf_counter()
+            comp_kg = kg_construct.construct(kg.text)
+            latencies.append(time.perf_counter() - start)
+
+            desired_triples.extend(kg.triples)
+            computed_triples.extend(comp_kg.triples)
+
+        del kg_construct
+        results[name] = (latencies, KnowledgeGraph.eval(desired_triples, computed_triples))
+
+    for name, (latencies, result) in results.items():
+        latencies = sorted(latencies)
+        print(f"{name:>8}: "
+              f"Mean: {statistics.mean(latencies):.3f}s "
+              f"P50: {latencies[len(latencies) // 2]:.3f}s "
+              f"P95: {latencies[int(len(latencies) * 0.95)]:.3f}s "
+              f"Micro-Precision: {result['precision']:.4f} "
+              f"Micro-Recall: {result['recall']:.4f} "
+              f"Micro-F1: {result['f1']:.4f}")
+
+
+if __name__ == '__main__':
+    main()
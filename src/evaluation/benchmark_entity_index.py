@@ -0,0 +1,70 @@
+import statistics
+import time
+
+import click
+
+from evaluation.corpora.red_fm import RedFM
+from waka.nlp.entity_linking import ElasticEntityLinker
+from waka.nlp.kg import EntityMention
+
+
+@click.command()
+@click.option("-i", "--index", "index_path", required=True, type=click.Path(exists=True),
+              help="Directory of the local entity index")
+@click.option("-n", "--num-texts", type=int, default=100)
+@click.option("-f", "--fuzziness", type=int, default=0)
+def main(index_path, num_texts, fuzziness):
+    # Both linkers get the gold mentions of RED^FM, so only candidate retrieval is compared.
+    linkers = {"elastic": ElasticEntityLinker(), "local": ElasticEntityLinker(index_path=index_path)}
+    linkers["local"].retriever.fuzziness = fuzziness
+
+    latencies = {name: [] for name in linkers}
+    found = {name: 0 for name in linkers}
+    top_1 = {name: 0 for name in linkers}
+    overlaps = []
+    num_mentions = 0
+
+    dataset = RedFM()
+    while dataset.has_next() and len(latencies["local"]) < num_texts:
+        kg = dataset.next()
+        gold = {(e.start_idx, e.end_idx): e.url for e in kg.entity_mentions}
+        mentions = [EntityMention(url=None, text=e.text, start_idx=e.start_idx, end_idx=e.end_idx, e_type=e.e_type)
+                    for e in kg.entity_mentions]
+        num_mentions += len(gold)
+
+        candidates = {}
+        for name, linker in linkers.items():
+            start = time.perf_counter()
+            linked = linker.process(kg.text, mentions)
+            latencies[name].append(time.perf_counter() - start)
+
+            by_span = {}
+            for entity in sorted(linked, key=lambda e: -e.score):
+                by_span.setdefault((entity.start_idx, entity.end_idx), []).append(entity.url)
+
+            for span, url in gold.items():
+                urls = by_span.get(span, [])
+                found[name] += url in urls
+                top_1[name] += len(urls) > 0 and urls[0] == url
+
+            candidates[name] = {(entity.start_idx, entity.end_idx, entity.url) for entity in linked}
+
+        union = candidates["elastic"] | candidates["local"]
+        if len(union) > 0:
+            overlaps.append(len(candidates["elastic"] & candidates["local"]) / len(union))
+
+    for name in linkers:
+        times = sorted(latencies[name])
+        print(f"{name:>8}: "
+              f"Mean: {statistics.mean(times) * 1000:.1f}ms "
+              f"P50: {times[len(times) // 2] * 1000:.1f}ms "
+              f"P95: {times[int(len(times) * 0.95)] * 1000:.1f}ms "
+              f"Recall: {found[name] / max(1, num_mentions):.4f} "
+              f"Top-1: {top_1[name] / max(1, num_mentions):.4f}")
+
+    if len(overlaps) > 0:
+        print(f"Candidate overlap (Jaccard): {statistics.mean(overlaps):.4f}")
+
+
+if __name__ == '__main__':
+    main()
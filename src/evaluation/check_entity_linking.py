@@ -0,0 +1,81 @@
+import tempfile
+
+import click
+
+from waka.nlp.entity_index import EntityIndex, build_index
+from waka.nlp.entity_linking import ElasticEntityLinker, ElasticRetriever, LocalRetriever
+from waka.nlp.kg import EntityMention
+
+RECORDS = [
+    {"url": "http://www.wikidata.org/entity/Q30", "label": "United States of America",
+     "description": "country in North America", "search_key": "United States of America USA United States",
+     "frequency": 100},
+    {"url": "http://www.wikidata.org/entity/Q183", "label": "Germany", "description": "country in Central Europe",
+     "search_key": "Germany Federal Republic of Germany", "frequency": 100},
+    {"url": "http://www.wikidata.org/entity/Q573975", "label": "Bauhaus-Universität Weimar",
+     "description": "university in Weimar, Germany", "search_key": "Bauhaus-Universität Weimar Bauhaus University",
+     "frequency": 10},
+]
+
+TEXT = "The Bauhaus-Universität Weimar hosts German and American students."
+MENTIONS = [
+    EntityMention(url=None, text="Bauhaus-Universität Weimar", start_idx=4, end_idx=30, e_type="organization"),
+    EntityMention(url=None, text="German", start_idx=37, end_idx=43, e_type="misc"),
+    EntityMention(url=None, text="American", start_idx=48, end_idx=56, e_type="misc"),
+]
+
+
+class IndexBackedElasticsearch:
+    # Answers msearch requests from a local index, so the Elasticsearch retriever runs without a cluster.
+
+    def __init__(self, index: EntityIndex):
+        self.index = index
+
+    def msearch(self, searches):
+        responses = []
+        for search in searches[1::2]:
+            function_score = search["query"]["function_score"]
+            alpha = float(function_score["query"]["query_string"]["fields"][0].split("^")[1])
+            hits = self.index.search(function_score["query"]["query_string"]["query"], alpha,
+                                     function_score["field_value_factor"]["factor"], search["min_score"],
+                                     search["size"])
+            responses.append({"status": 200, "hits": {"hits": hits}})
+
+        return {"responses": responses}
+
+
+@click.command()
+@click.option("--min-score", type=float, default=0.0)
+def main(min_score):
+    # Runs ElasticEntityLinker.process through both candidate retrievers on a tiny index and checks that they
+    # link the same mentions, including the nationality expansion of the queries.
+    with tempfile.TemporaryDirectory() as path:
+        build_index(RECORDS, path)
+        index = EntityIndex(path)
+
+        local = ElasticEntityLinker(min_score=min_score, index_path=path)
+        elastic = ElasticEntityLinker(min_score=min_score, index_path=path)
+        elastic.retriever = ElasticRetriever(IndexBackedElasticsearch(index), elastic.index_name,
+                                             elastic.search_template)
+        assert isinstance(local.retriever, LocalRetriever)
+
+        results = {}
+        for name, linker in (("local", local), ("elastic", elastic)):
+            linked = linker.process(TEXT, MENTIONS)
+            results[name] = {(entity.start_idx, entity.end_idx, entity.url) for entity in linked}
+            print(f"{name:>8}: {sorted(results[name])}")
+
+        expected = {(4, 30, RECORDS[2]["url"]), (37, 43, RECORDS[1]["url"]), (48, 56, RECORDS[0]["url"])}
+        for name, result in results.items():
+            missing = expected - result
+            if len(missing) > 0:
+                raise click.ClickException(f"{name} retriever did not link {sorted(missing)}")
+
+        if results["local"] != results["elastic"]:
+            raise click.ClickException("The retrievers linked different candidates")
+
+    click.echo("OK")
+
+
+if __name__ == '__main__':
+    main()
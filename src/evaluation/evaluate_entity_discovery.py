@@ -34,9 +34,7 @@ def main(stage: str) -> None:
 
     while dataset.has_next():
         kg = dataset.next()
-        el_pipeline.process(kg.text)
-
-        entities = el_pipeline.get()
+        entities = el_pipeline.process(kg.text).result()
 
         if stage == "rerank":
             aggregated = []
@@ -21,9 +21,7 @@ def main():
 
     while dataset.has_next():
         kg = dataset.next()
-        rl_pipeline.process(kg.text)
-
-        triples = rl_pipeline.get()
+        triples = rl_pipeline.process(kg.text).result()
 
         for t in kg.triples:
             t.predicate.url = None
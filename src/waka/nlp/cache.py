@@ -0,0 +1,191 @@
+import copy
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Any, Optional, List, Tuple
+
+import cachetools
+
+from waka.nlp.chunking import DocumentChunker, map_offsets
+from waka.nlp.text_processor import TextProcessor
+
+MISSING = object()
+
+
+class TieredCache:
+
+    def __init__(self, name: str, maxsize: int = 10000, ttl: Optional[float] = None, path: Optional[str] = None):
+        self.name = name
+        if ttl is None:
+            self.memory = cachetools.LRUCache(maxsize=maxsize)
+        else:
+            self.memory = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        # The optional disk tier is shared by all processes and survives restarts. It is not evicted, but entries
+        # older than the TTL are ignored.
+        self.path = path
+        self.disk = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.disk = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.disk.execute("PRAGMA journal_mode=WAL")
+            self.disk.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, created REAL)")
+            columns = [row[1] for row in self.disk.execute("PRAGMA table_info(cache)")]
+            if "created" not in columns:
+                self.disk.execute("ALTER TABLE cache ADD COLUMN created REAL")
+            self.disk.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.reported = (0, 0)
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Any:
+        with self.lock:
+            value = self.memory.get(key, MISSING)
+            if value is MISSING and self.disk is not None:
+                row = self.disk.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+                if row is not None and (self.ttl is None or row[1] is None or time.time() - row[1] <= self.ttl):
+                    value = pickle.loads(row[0])
+                    self.memory[key] = value
+
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self.lock:
+            self.memory[key] = value
+            if self.disk is not None:
+                self.disk.execute("INSERT OR REPLACE INTO cache (key, value, created) VALUES (?, ?, ?)",
+                                  (key, pickle.dumps(value), time.time()))
+                self.disk.commit()
+
+    def collect_metrics(self) -> List[tuple]:
+        # Only the hits and misses since the last call are reported, as increments of a counter.
+        with self.lock:
+            hits = self.hits - self.reported[0]
+            misses = self.misses - self.reported[1]
+            self.reported = (self.hits, self.misses)
+
+        labels = {"cache": self.name}
+        return [("inc", "waka_cache_requests_total", hits, {**labels, "result": "hit"}),
+                ("inc", "waka_cache_requests_total", misses, {**labels, "result": "miss"})]
+
+
+class SentenceCachedProcessor(TextProcessor):
+
+    def __init__(self, processor: type[TextProcessor], maxsize: int = 10000, path: Optional[str] = None,
+                 version: Optional[str] = None, max_sentence_chars: int = 2000):
+        super().__init__()
+        self.processor = processor()
+        # The configuration and the model version of the wrapped processor are part of every key, so changed models
+        # or parameters don't return stale results from the disk tier. The optional version invalidates all entries,
+        # e.g. after the weights of a model were replaced under the same name.
+        self.namespace = (repr(processor), version)
+        self.cache = TieredCache(self.processor.__class__.__name__, maxsize=maxsize, path=path)
+        self.splitter = DocumentChunker(max_chars=max_sentence_chars)
+
+    def process(self, text: str, in_data: Any) -> Optional[List[Any]]:
+        return self.process_batch([text], [in_data])[0]
+
+    def process_batch(self, texts: List[str], in_data: List[Any]) -> List[Optional[List[Any]]]:
+        self.processor.options = self.options
+
+        # Only stages that get the text itself can be cached by sentence.
+        if any(data != text for text, data in zip(texts, in_data)):
+            return self.processor.process_batch(texts, in_data)
+
+        options = tuple(sorted(self.options.items()))
+        model_version = self.processor.model_version()
+        text_sentences: List[List[Tuple[int, List[int], str]]] = []
+        missing = {}
+        results = {}
+
+        for text in texts:
+            sentences = []
+            for start, end in self.splitter.sentence_spans(text):
+                # Sentences that only differ in whitespace or Unicode composition share their results. The wrapped
+                # processor gets the normalised sentence, its offsets are mapped back to the original one.
+                sentence, positions = normalize(text[start:end])
+                key = self.cache.key(self.namespace, model_version, options, sentence)
+                sentences.append((start, positions, key))
+
+                if key in results or key in missing:
+                    continue
+
+                cached = self.cache.get(key)
+                if cached is MISSING:
+                    missing[key] = sentence
+                else:
+                    results[key] = cached
+
+            text_sentences.append(sentences)
+
+        # Only new and changed sentences are processed, all of them in one batch. Failed sentences are not cached.
+        if len(missing) > 0:
+            sentences = list(missing.values())
+            for key, result in zip(missing.keys(), self.processor.process_batch(sentences, sentences)):
+                results[key] = result
+                if result is not None:
+                    self.cache.set(key, result)
+
+        out_data = []
+        for sentences in text_sentences:
+            text_result = []
+            for start, positions, key in sentences:
+                result = results[key]
+                if result is None:
+                    continue
+
+                # Results are cached with offsets relative to their normalised sentence, copies are moved into the text.
+                result = copy.deepcopy(result)
+                mapped = set()
+                for item in result:
+                    map_offsets(item, positions, start, mapped)
+                text_result.extend(result)
+
+            out_data.append(text_result)
+
+        return out_data
+
+    def collect_metrics(self) -> List[tuple]:
+        return self.cache.collect_metrics() + self.processor.collect_metrics()
+
+
+def normalize(sentence: str) -> Tuple[str, List[int]]:
+    # Whitespace runs are collapsed into one space and every base character with its combining characters is
+    # composed (NFC). For every offset of the normalised sentence, including its end, the offset in the original
+    # sentence is returned as well. Case is kept, since the recognizers and the extractor are case-sensitive.
+    chars = []
+    positions = []
+    i = 0
+    while i < len(sentence):
+        j = i + 1
+        if sentence[i].isspace():
+            while j < len(sentence) and sentence[j].isspace():
+                j += 1
+            cluster = " "
+        else:
+            while j < len(sentence) and unicodedata.combining(sentence[j]):
+                j += 1
+            cluster = unicodedata.normalize("NFC", sentence[i:j])
+
+        chars.append(cluster)
+        positions.extend([i] * len(cluster))
+        i = j
+
+    positions.append(len(sentence))
+    return "".join(chars), positions
@@ -0,0 +1,203 @@
+import copy
+import re
+from typing import List, Tuple, Any, Optional, Set
+
+from nltk.tokenize import PunktSentenceTokenizer
+
+from waka.nlp.kg import EntityMention, LinkedEntity, Triple, UniqueEntity
+from waka.nlp.text_processor import TextProcessor
+
+Span = Tuple[int, int]
+
+
+class DocumentChunker:
+    PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+    def __init__(self, max_chars: int = 2000, overlap: int = 1):
+        if max_chars < 1:
+            raise ValueError("Chunks must have at least one character")
+
+        self.max_chars = max_chars
+        self.overlap = overlap
+        self.sentence_tokenizer = PunktSentenceTokenizer()
+
+    def split(self, text: str) -> List[Span]:
+        sentences = self.sentence_spans(text)
+        chunks = []
+
+        # Chunks are packed greedily with whole sentences, and each chunk repeats the last sentences of its
+        # predecessor, so mentions and relations that cross a seam are still seen in one piece.
+        first = 0
+        while first < len(sentences):
+            last = first
+            while last + 1 < len(sentences) and sentences[last + 1][1] - sentences[first][0] <= self.max_chars:
+                last += 1
+
+            chunks.append((sentences[first][0], sentences[last][1]))
+            if last == len(sentences) - 1:
+                break
+
+            # The overlap shrinks if the next sentence wouldn't fit into a chunk together with it.
+            first = max(first + 1, last + 1 - self.overlap)
+            while first <= last and sentences[last + 1][1] - sentences[first][0] > self.max_chars:
+                first += 1
+
+        return chunks
+
+    def sentence_spans(self, text: str) -> List[Span]:
+        # Sentences never cross paragraph breaks, and sentences longer than a chunk are cut at whitespace.
+        spans = []
+        start = 0
+        for paragraph_break in [*self.PARAGRAPH_BREAK.finditer(text), None]:
+            end = len(text) if paragraph_break is None else paragraph_break.start()
+            for sentence_start, sentence_end in self.sentence_tokenizer.span_tokenize(text[start:end]):
+                spans.extend(self._split_long(text, start + sentence_start, start + sentence_end))
+
+            if paragraph_break is not None:
+                start = paragraph_break.end()
+
+        return spans
+
+    def _split_long(self, text: str, start: int, end: int) -> List[Span]:
+        spans = []
+        while end - start > self.max_chars:
+            cut = text.rfind(" ", start + 1, start + self.max_chars)
+            if cut == -1:
+                cut = start + self.max_chars
+
+            spans.append((start, cut))
+            start = cut
+            while start < end and text[start].isspace():
+                start += 1
+
+        spans.append((start, end))
+        return spans
+
+
+class ChunkedProcessor(TextProcessor):
+
+    def __init__(self, processor: type[TextProcessor], max_chars: int = 2000, overlap: int = 1):
+        super().__init__()
+        self.processor = processor()
+        self.chunker = DocumentChunker(max_chars, overlap)
+
+    def process(self, text: str, in_data: Any) -> Optional[List[Any]]:
+        return self.process_batch([text], [in_data])[0]
+
+    def process_batch(self, texts: List[str], in_data: List[Any]) -> List[Optional[List[Any]]]:
+        # The chunks of all texts are passed to the wrapped processor as one batch, so processors with native
+        # batching process them in parallel.
+        chunk_texts = []
+        chunk_data = []
+        chunk_origins = []
+        num_chunks = []
+        for i, (text, data) in enumerate(zip(texts, in_data)):
+            spans = self.chunker.split(text) if len(text) > self.chunker.max_chars else [(0, len(text))]
+            num_chunks.append(len(spans))
+            for start, end in spans:
+                chunk_texts.append(text[start:end])
+                chunk_data.append(_slice(data, text, start, end))
+                chunk_origins.append((i, start))
+
+        self.processor.options = self.options
+        chunk_results = self.processor.process_batch(chunk_texts, chunk_data)
+
+        # A text without any sentence, e.g. only whitespace, has no chunks and an empty result.
+        results = [[] if n == 0 else None for n in num_chunks]
+        seen = [set() for _ in texts]
+        for (i, start), chunk_result in zip(chunk_origins, chunk_results):
+            if chunk_result is None:
+                continue
+
+            if num_chunks[i] == 1:
+                results[i] = chunk_result
+                continue
+
+            if results[i] is None:
+                results[i] = []
+
+            shifted = set()
+            for item in chunk_result:
+                shift_offsets(item, start, shifted)
+
+                # Items found in the overlap of two chunks are only kept once.
+                key = _key(item)
+                if key is not None:
+                    if key in seen[i]:
+                        continue
+                    seen[i].add(key)
+
+                results[i].append(item)
+
+        return results
+
+    def collect_metrics(self) -> List[tuple]:
+        return self.processor.collect_metrics()
+
+    def model_version(self) -> tuple:
+        self.processor.options = self.options
+        return self.processor.model_version()
+
+
+def _slice(data: Any, text: str, start: int, end: int) -> Any:
+    if isinstance(data, str) and data == text:
+        return text[start:end]
+
+    if isinstance(data, list) and all(isinstance(item, EntityMention) for item in data):
+        sliced = []
+        for item in data:
+            if item.start_idx is not None and start <= item.start_idx and item.end_idx <= end:
+                item = copy.copy(item)
+                item.start_idx -= start
+                item.end_idx -= start
+                sliced.append(item)
+
+        return sliced
+
+    return data
+
+
+def shift_offsets(item: Any, offset: int, shifted: Set[int]) -> None:
+    # Mentions can be shared, e.g. by several triples, but must be moved only once.
+    if offset == 0 or id(item) in shifted:
+        return
+    shifted.add(id(item))
+
+    if isinstance(item, Triple):
+        shift_offsets(item.subject, offset, shifted)
+        shift_offsets(item.object, offset, shifted)
+    elif isinstance(item, UniqueEntity):
+        for mention in item.mentions:
+            shift_offsets(mention, offset, shifted)
+    elif isinstance(item, EntityMention) and item.start_idx is not None:
+        item.start_idx += offset
+        item.end_idx += offset
+
+
+def map_offsets(item: Any, positions: List[int], offset: int, mapped: Set[int]) -> None:
+    # Like shift_offsets, but every offset is first looked up in positions, e.g. to map offsets of a normalised
+    # sentence back to the original one.
+    if id(item) in mapped:
+        return
+    mapped.add(id(item))
+
+    if isinstance(item, Triple):
+        map_offsets(item.subject, positions, offset, mapped)
+        map_offsets(item.object, positions, offset, mapped)
+    elif isinstance(item, UniqueEntity):
+        for mention in item.mentions:
+            map_offsets(mention, positions, offset, mapped)
+    elif isinstance(item, EntityMention) and item.start_idx is not None:
+        item.start_idx = offset + positions[min(item.start_idx, len(positions) - 1)]
+        item.end_idx = offset + positions[min(item.end_idx, len(positions) - 1)]
+
+
+def _key(item: Any) -> Optional[tuple]:
+    if isinstance(item, Triple):
+        return _key(item.subject), item.predicate.text, item.predicate.url, _key(item.object)
+    elif isinstance(item, LinkedEntity):
+        return item.start_idx, item.end_idx, item.url
+    elif isinstance(item, EntityMention):
+        return item.start_idx, item.end_idx, item.text, item.url
+
+    return None
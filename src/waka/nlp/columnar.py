@@ -0,0 +1,310 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from multiprocessing import shared_memory, resource_tracker
+from typing import List, Optional, Dict, Any, Tuple
+
+import numpy as np
+
+from waka.nlp.kg import EntityMention, LinkedEntity, UniqueEntity, Triple, Property
+
+MENTION = 0
+ENTITY = 1
+TRIPLE = 2
+
+_NONE = -1
+
+_MENTION_COLUMNS = {
+    "kind": np.uint8, "start": np.int32, "end": np.int32, "text": np.int32, "url": np.int32, "e_type": np.int32,
+    "label": np.int32, "description": np.int32, "score": np.float64, "has_score": np.bool_
+}
+_ENTITY_COLUMNS = {
+    "url": np.int32, "label": np.int32, "description": np.int32, "e_type": np.int32, "score": np.float64,
+    "has_score": np.bool_, "mentions_start": np.int32, "mentions_end": np.int32
+}
+_PROPERTY_COLUMNS = {
+    "text": np.int32, "url": np.int32, "label": np.int32, "description": np.int32
+}
+_TRIPLE_COLUMNS = {
+    "subject_kind": np.uint8, "subject": np.int32, "predicate": np.int32, "object_kind": np.uint8,
+    "object": np.int32, "score": np.float64, "has_score": np.bool_
+}
+_ROOT_COLUMNS = {
+    "kind": np.uint8, "index": np.int32
+}
+
+_TABLES = {
+    "mentions": _MENTION_COLUMNS,
+    "entities": _ENTITY_COLUMNS,
+    "properties": _PROPERTY_COLUMNS,
+    "triples": _TRIPLE_COLUMNS,
+    "roots": _ROOT_COLUMNS
+}
+
+
+@dataclass
+class ColumnarBatch:
+    strings: List[str]
+    lengths: Dict[str, int]
+    columns: Optional[Dict[str, np.ndarray]] = None
+    shm_name: Optional[str] = None
+    shm_layout: List[Tuple[str, str, int, int]] = field(default_factory=list)
+
+    @property
+    def num_items(self) -> int:
+        return self.lengths["roots"]
+
+
+class _Encoder:
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.rows = {table: {column: [] for column in columns} for table, columns in _TABLES.items()}
+        self.refs = {}
+
+    def string(self, value: Optional[str]) -> int:
+        if value is None:
+            return _NONE
+
+        string_id = self.string_ids.get(value)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.string_ids[value] = string_id
+            self.strings.append(value)
+
+        return string_id
+
+    def append(self, table: str, **values) -> int:
+        rows = self.rows[table]
+        for column, value in values.items():
+            rows[column].append(value)
+
+        return len(next(iter(rows.values()))) - 1
+
+    def item(self, item: Any) -> Tuple[int, int]:
+        # Objects referenced from several places, e.g. an entity in multiple triples, are encoded only once.
+        ref = self.refs.get(id(item))
+        if ref is not None:
+            return ref
+
+        if isinstance(item, Triple):
+            ref = TRIPLE, self.triple(item)
+        elif isinstance(item, UniqueEntity):
+            ref = ENTITY, self.entity(item)
+        elif isinstance(item, EntityMention):
+            ref = MENTION, self.mention(item)
+        else:
+            raise TypeError(f"Can't encode {type(item)} in columnar format")
+
+        self.refs[id(item)] = ref
+        return ref
+
+    def mention(self, mention: EntityMention) -> int:
+        linked = isinstance(mention, LinkedEntity)
+        score = mention.score if linked else None
+        return self.append(
+            "mentions",
+            kind=int(linked),
+            start=_NONE if mention.start_idx is None else mention.start_idx,
+            end=_NONE if mention.end_idx is None else mention.end_idx,
+            text=self.string(mention.text),
+            url=self.string(mention.url),
+            e_type=self.string(mention.e_type),
+            label=self.string(mention.label) if linked else _NONE,
+            description=self.string(mention.description) if linked else _NONE,
+            score=0.0 if score is None else score,
+            has_score=score is not None)
+
+    def entity(self, entity: UniqueEntity) -> int:
+        # The mentions of an entity are stored as a contiguous range of the mention table.
+        mentions_start = len(self.rows["mentions"]["kind"])
+        for mention in entity.mentions:
+            self.mention(mention)
+
+        return self.append(
+            "entities",
+            url=self.string(entity.url),
+            label=self.string(entity.label),
+            description=self.string(entity.description),
+            e_type=self.string(entity.e_type),
+            score=0.0 if entity.score is None else entity.score,
+            has_score=entity.score is not None,
+            mentions_start=mentions_start,
+            mentions_end=len(self.rows["mentions"]["kind"]))
+
+    def triple(self, triple: Triple) -> int:
+        subject_kind, subject = self.item(triple.subject)
+        object_kind, object_ = self.item(triple.object)
+        predicate = self.append(
+            "properties",
+            text=self.string(triple.predicate.text),
+            url=self.string(triple.predicate.url),
+            label=self.string(triple.predicate.label),
+            description=self.string(triple.predicate.description))
+
+        return self.append(
+            "triples",
+            subject_kind=subject_kind,
+            subject=subject,
+            predicate=predicate,
+            object_kind=object_kind,
+            object=object_,
+            score=0.0 if triple.score is None else triple.score,
+            has_score=triple.score is not None)
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        columns = {}
+        for table, table_columns in _TABLES.items():
+            for column, dtype in table_columns.items():
+                columns[f"{table}.{column}"] = np.asarray(self.rows[table][column], dtype=dtype)
+
+        return columns
+
+
+class _Decoder:
+    def __init__(self, batch: ColumnarBatch, columns: Dict[str, np.ndarray]):
+        self.strings = batch.strings
+        self.columns = {name: column.tolist() for name, column in columns.items()}
+        self.mentions = {}
+        self.entities = {}
+        self.triples = {}
+
+    def string(self, string_id: int) -> Optional[str]:
+        return None if string_id == _NONE else self.strings[string_id]
+
+    def item(self, kind: int, index: int) -> Any:
+        if kind == TRIPLE:
+            return self.triple(index)
+        elif kind == ENTITY:
+            return self.entity(index)
+
+        return self.mention(index)
+
+    def mention(self, i: int) -> EntityMention:
+        if i in self.mentions:
+            return self.mentions[i]
+
+        c = self.columns
+        start = c["mentions.start"][i]
+        end = c["mentions.end"][i]
+        values = dict(
+            url=self.string(c["mentions.url"][i]),
+            start_idx=None if start == _NONE else start,
+            end_idx=None if end == _NONE else end,
+            text=self.string(c["mentions.text"][i]),
+            e_type=self.string(c["mentions.e_type"][i]))
+
+        if c["mentions.kind"][i] == 1:
+            mention = _construct(
+                LinkedEntity,
+                **values,
+                label=self.string(c["mentions.label"][i]),
+                description=self.string(c["mentions.description"][i]),
+                score=c["mentions.score"][i] if c["mentions.has_score"][i] else None)
+        else:
+            mention = _construct(EntityMention, **values)
+
+        self.mentions[i] = mention
+        return mention
+
+    def entity(self, i: int) -> UniqueEntity:
+        if i in self.entities:
+            return self.entities[i]
+
+        c = self.columns
+        entity = _construct(
+            UniqueEntity,
+            url=self.string(c["entities.url"][i]),
+            label=self.string(c["entities.label"][i]),
+            description=self.string(c["entities.description"][i]),
+            score=c["entities.score"][i] if c["entities.has_score"][i] else None,
+            mentions=[self.mention(m) for m in range(c["entities.mentions_start"][i], c["entities.mentions_end"][i])],
+            e_type=self.string(c["entities.e_type"][i]))
+
+        self.entities[i] = entity
+        return entity
+
+    def triple(self, i: int) -> Triple:
+        if i in self.triples:
+            return self.triples[i]
+
+        c = self.columns
+        p = c["triples.predicate"][i]
+        triple = _construct(
+            Triple,
+            subject=self.item(c["triples.subject_kind"][i], c["triples.subject"][i]),
+            predicate=_construct(
+                Property,
+                text=self.string(c["properties.text"][p]),
+                url=self.string(c["properties.url"][p]),
+                label=self.string(c["properties.label"][p]),
+                description=self.string(c["properties.description"][p])),
+            object=self.item(c["triples.object_kind"][i], c["triples.object"][i]),
+            score=c["triples.score"][i] if c["triples.has_score"][i] else None,
+            id_=None)
+        triple.id_ = str(triple.__hash__())
+
+        self.triples[i] = triple
+        return triple
+
+
+def _construct(cls: type, **values) -> Any:
+    # The values were validated when the objects were created in the worker, so validation is skipped here just
+    # like it is when unpickling.
+    obj = cls.__new__(cls)
+    obj.__dict__.update(values)
+    return obj
+
+
+def can_encode(data: Any) -> bool:
+    return isinstance(data, list) and all(isinstance(item, (EntityMention, UniqueEntity, Triple)) for item in data)
+
+
+def encode(items: List[EntityMention | UniqueEntity | Triple], use_shared_memory: bool = False) -> ColumnarBatch:
+    encoder = _Encoder()
+    for item in items:
+        kind, index = encoder.item(item)
+        encoder.append("roots", kind=kind, index=index)
+
+    columns = encoder.columns()
+    lengths = {table: len(next(iter(rows.values()))) for table, rows in encoder.rows.items()}
+
+    if not use_shared_memory:
+        return ColumnarBatch(strings=encoder.strings, lengths=lengths, columns=columns)
+
+    # All columns are packed into one shared memory block, only its name and layout are pickled.
+    size = max(1, sum(column.nbytes for column in columns.values()))
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    layout = []
+    offset = 0
+    for name, column in columns.items():
+        shm.buf[offset:offset + column.nbytes] = column.tobytes()
+        layout.append((name, column.dtype.str, offset, len(column)))
+        offset += column.nbytes
+    shm.close()
+    # The decoding process owns the block and unlinks it, so the tracker of this process must not clean it up too.
+    resource_tracker.unregister(shm._name, "shared_memory")
+
+    return ColumnarBatch(strings=encoder.strings, lengths=lengths, shm_name=shm.name, shm_layout=layout)
+
+
+def decode(batch: ColumnarBatch) -> List[EntityMention | UniqueEntity | Triple]:
+    if batch.shm_name is None:
+        return _decode(batch, batch.columns)
+
+    shm = shared_memory.SharedMemory(name=batch.shm_name)
+    try:
+        columns = {}
+        for name, dtype, offset, length in batch.shm_layout:
+            columns[name] = np.frombuffer(shm.buf, dtype=np.dtype(dtype), count=length, offset=offset).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return _decode(batch, columns)
+
+
+def _decode(batch: ColumnarBatch, columns: Dict[str, np.ndarray]) -> List[EntityMention | UniqueEntity | Triple]:
+    decoder = _Decoder(batch, columns)
+    return [decoder.item(kind, index)
+            for kind, index in zip(decoder.columns["roots.kind"], decoder.columns["roots.index"])]
@@ -0,0 +1,41 @@
+import logging
+import os
+from typing import Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def select_device(device: Optional[str] = None) -> str:
+    # WAKA_DEVICE is "auto" (default), "cpu", "cuda" or a specific GPU like "cuda:1". CUDA falls back to the CPU if
+    # no GPU is available, so the same configuration runs on CPU-only nodes.
+    device = device or os.getenv("WAKA_DEVICE", "auto")
+
+    if device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+
+    if device.startswith("cuda") and not torch.cuda.is_available():
+        logger.warning(f"CUDA is not available, use the CPU instead of {device}")
+        return "cpu"
+
+    return device
+
+
+def quantization_enabled(device: str, quantize: Optional[bool] = None) -> bool:
+    if quantize is None:
+        quantize = os.getenv("WAKA_QUANTIZE", "0") == "1"
+
+    # Dynamically quantised kernels only exist for the CPU.
+    return quantize and device == "cpu"
+
+
+def prepare_model(model: torch.nn.Module, device: str, quantize: Optional[bool] = None) -> torch.nn.Module:
+    model.eval()
+
+    if quantization_enabled(device, quantize):
+        # Weights of linear layers are stored as int8 and activations are quantised on the fly, which needs no
+        # calibration data and covers nearly all of the compute in transformer models.
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    return model.to(device)
@@ -0,0 +1,311 @@
+import bisect
+import fileinput
+import functools
+import json
+import os
+import re
+from array import array
+from collections import Counter
+from typing import List, Iterable, Iterator, Dict, Any, Tuple, Optional
+
+import click
+import numpy as np
+from Levenshtein import distance
+
+TOKEN = re.compile(r"\w+")
+OR_OPERATOR = re.compile(r"(?<!\\)\|\||\bOR\b")
+ESCAPED = re.compile(r"\\(.)")
+
+
+def tokenize(text: str) -> List[str]:
+    # Like the standard analyzer of Elasticsearch: lowercased runs of word characters.
+    return TOKEN.findall(text.lower())
+
+
+def parse_query(query: str) -> List[List[str]]:
+    # Only the subset of the query_string syntax the linkers generate is supported: clauses joined by "||" or "OR",
+    # whose terms are all required. Any other operator character is dropped by the tokenizer.
+    return [terms for terms in (tokenize(ESCAPED.sub(r"\1", clause)) for clause in OR_OPERATOR.split(query)) if terms]
+
+
+class _Strings:
+    # Strings stored back to back in one memory-mapped blob, the i-th string is data[offsets[i]:offsets[i + 1]].
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+
+class EntityIndex:
+    # A local replacement for the Elasticsearch entity index. All arrays are memory-mapped, so opening the index is
+    # cheap and the pages are shared by all worker processes.
+    FIELDS = ("label", "search_key")
+    K1 = 1.2
+    B = 0.75
+    FUZZY_PREFIX_LENGTH = 2
+    MAX_EXPANSIONS = 50
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as in_file:
+            self.meta = json.load(in_file)
+
+        def load(name: str) -> np.ndarray:
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.strings = _Strings(load("strings"), load("string_offsets"))
+        self.terms = _Strings(load("terms"), load("term_offsets"))
+        self.frequency = load("frequency")
+        self.lengths = {field: load(f"{field}_lengths") for field in self.FIELDS}
+        self.postings = {field: (load(f"{field}_pointers"), load(f"{field}_docs"), load(f"{field}_tf"))
+                         for field in self.FIELDS}
+
+    def search(self, query: str, alpha: float, beta: float, min_score: float, max_results: int,
+               fuzziness: int = 0, prefix: bool = False) -> List[Dict[str, Any]]:
+        # Emulates the function_score query of the linkers: every clause is scored by BM25 in the field it matches
+        # best, with the label boosted by alpha, the clauses are summed, and the sum is multiplied by
+        # log10(1 + beta * frequency). Hits have the format of Elasticsearch hits.
+        clause_docs = []
+        clause_scores = []
+        for terms in parse_query(query):
+            field_docs = []
+            field_scores = []
+            for field, boost in zip(self.FIELDS, (alpha, 1.0)):
+                docs, scores = self._match_all(field, terms, fuzziness, prefix)
+                field_docs.append(docs)
+                field_scores.append(scores * boost)
+
+            docs, scores = _reduce(np.concatenate(field_docs), np.concatenate(field_scores), np.maximum)
+            clause_docs.append(docs)
+            clause_scores.append(scores)
+
+        if len(clause_docs) == 0:
+            return []
+
+        docs, scores = _reduce(np.concatenate(clause_docs), np.concatenate(clause_scores), np.add)
+        scores = scores * np.log10(1 + beta * self.frequency[docs])
+
+        selected = scores >= min_score
+        docs, scores = docs[selected], scores[selected]
+        if len(docs) > max_results:
+            top = np.argpartition(-scores, max_results - 1)[:max_results]
+            docs, scores = docs[top], scores[top]
+
+        return [self.hit(int(docs[i]), float(scores[i])) for i in np.lexsort((docs, -scores))]
+
+    def hit(self, doc: int, score: float) -> Dict[str, Any]:
+        url, label, description = (self.strings[3 * doc + i].decode("utf-8") for i in range(3))
+        source = {"frequency": float(self.frequency[doc])}
+        if label:
+            source["label"] = label
+        if description:
+            source["description"] = description
+
+        return {"_id": url, "_score": score, "_source": source}
+
+    def lookup(self, term: str, fuzziness: int = 0, prefix: bool = False) -> List[int]:
+        key = term.encode("utf-8")
+        term_ids = []
+
+        if prefix:
+            # The terms are sorted by their UTF-8 bytes, and 0xff never occurs in UTF-8.
+            start = bisect.bisect_left(self.terms, key)
+            end = bisect.bisect_left(self.terms, key + b"\xff", lo=start)
+            term_ids.extend(range(start, min(end, start + self.MAX_EXPANSIONS)))
+        else:
+            i = bisect.bisect_left(self.terms, key)
+            if i < len(self.terms) and self.terms[i] == key:
+                term_ids.append(i)
+
+        if fuzziness > 0 and len(term) > self.FUZZY_PREFIX_LENGTH:
+            # Only terms that share the first characters are compared, which keeps the scanned range small.
+            fuzzy_prefix = term[:self.FUZZY_PREFIX_LENGTH].encode("utf-8")
+            start = bisect.bisect_left(self.terms, fuzzy_prefix)
+            end = bisect.bisect_left(self.terms, fuzzy_prefix + b"\xff", lo=start)
+            for i in range(start, end):
+                candidate = self.terms[i].decode("utf-8")
+                if abs(len(candidate) - len(term)) <= fuzziness and distance(candidate, term) <= fuzziness:
+                    term_ids.append(i)
+                    if len(term_ids) >= self.MAX_EXPANSIONS:
+                        break
+
+        return term_ids
+
+    def _match_all(self, field: str, terms: List[str], fuzziness: int, prefix: bool) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        docs = np.empty(0, dtype=np.int32)
+        scores = np.empty(0, dtype=np.float64)
+
+        # All terms of a clause have to occur in the same field, the last one may be a prefix.
+        for i, term in enumerate(terms):
+            term_docs, term_scores = self._postings(field, self.lookup(term, fuzziness, prefix and i == len(terms) - 1))
+            if i == 0:
+                docs, scores = term_docs, term_scores
+            else:
+                docs, left, right = np.intersect1d(docs, term_docs, assume_unique=True, return_indices=True)
+                scores = scores[left] + term_scores[right]
+
+            if len(docs) == 0:
+                break
+
+        return docs, scores
+
+    def _postings(self, field: str, term_ids: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        pointers, posting_docs, posting_tf = self.postings[field]
+        num_docs = self.meta["doc_count"][field]
+        avg_length = self.meta["avg_length"][field]
+
+        docs = []
+        scores = []
+        for term_id in term_ids:
+            start, end = int(pointers[term_id]), int(pointers[term_id + 1])
+            term_docs = np.asarray(posting_docs[start:end])
+            tf = np.asarray(posting_tf[start:end], dtype=np.float64)
+            length = np.asarray(self.lengths[field][term_docs], dtype=np.float64)
+
+            # BM25 like Lucene computes it, without the lossy encoding of field lengths.
+            idf = np.log(1 + (num_docs - (end - start) + 0.5) / ((end - start) + 0.5))
+            docs.append(term_docs)
+            scores.append(idf * tf / (tf + self.K1 * (1 - self.B + self.B * length / avg_length)))
+
+        if len(docs) == 0:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64)
+
+        # A document matching several expansions of a term gets the score of the best one.
+        return _reduce(np.concatenate(docs), np.concatenate(scores), np.maximum)
+
+
+def _reduce(docs: np.ndarray, scores: np.ndarray, ufunc: np.ufunc) -> Tuple[np.ndarray, np.ndarray]:
+    if len(docs) == 0:
+        return docs, scores
+
+    order = np.argsort(docs, kind="stable")
+    docs, scores = docs[order], scores[order]
+    unique_docs, starts = np.unique(docs, return_index=True)
+    return unique_docs, ufunc.reduceat(scores, starts)
+
+
+def build_index(records: Iterable[Dict[str, Any]], path: str) -> int:
+    os.makedirs(path, exist_ok=True)
+    vocabulary: Dict[str, int] = {}
+    string_data = bytearray()
+    string_offsets = array("q", [0])
+    frequency = array("d")
+    lengths = {field: array("l") for field in EntityIndex.FIELDS}
+    postings = {field: (array("l"), array("l"), array("l")) for field in EntityIndex.FIELDS}
+
+    num_docs = 0
+    for doc, record in enumerate(records):
+        for value in (record["url"], record.get("label"), record.get("description")):
+            string_data.extend((value or "").encode("utf-8"))
+            string_offsets.append(len(string_data))
+
+        # Like the field_value_factor of the query, documents without a frequency count as 1.
+        frequency.append(1.0 if record.get("frequency") is None else float(record["frequency"]))
+
+        for field in EntityIndex.FIELDS:
+            counts = Counter(tokenize(record.get(field) or ""))
+            lengths[field].append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings[field][0].append(vocabulary.setdefault(term, len(vocabulary)))
+                postings[field][1].append(doc)
+                postings[field][2].append(tf)
+
+        num_docs = doc + 1
+
+    # Terms are stored sorted by their UTF-8 bytes for binary and prefix search.
+    terms = sorted(vocabulary, key=lambda t: t.encode("utf-8"))
+    ranks = np.empty(len(terms), dtype=np.int64)
+    ranks[[vocabulary[term] for term in terms]] = np.arange(len(terms))
+    term_data = [term.encode("utf-8") for term in terms]
+
+    def save(name: str, values: Any, dtype: Any) -> None:
+        np.save(os.path.join(path, f"{name}.npy"), np.asarray(values, dtype=dtype))
+
+    save("strings", np.frombuffer(bytes(string_data), dtype=np.uint8), np.uint8)
+    save("string_offsets", string_offsets, np.int64)
+    save("terms", np.frombuffer(b"".join(term_data), dtype=np.uint8), np.uint8)
+    save("term_offsets", np.concatenate([[0], np.cumsum([len(data) for data in term_data], dtype=np.int64)]),
+         np.int64)
+    save("frequency", frequency, np.float32)
+
+    meta = {"num_docs": num_docs, "doc_count": {}, "avg_length": {}}
+    for field in EntityIndex.FIELDS:
+        field_lengths = np.asarray(lengths[field], dtype=np.int32)
+        term_ids = ranks[np.asarray(postings[field][0], dtype=np.int64)]
+        docs = np.asarray(postings[field][1], dtype=np.int32)
+        tf = np.minimum(np.asarray(postings[field][2], dtype=np.int64), np.iinfo(np.uint16).max)
+
+        order = np.lexsort((docs, term_ids))
+        pointers = np.concatenate([[0], np.cumsum(np.bincount(term_ids, minlength=len(terms)))])
+
+        save(f"{field}_lengths", field_lengths, np.int32)
+        save(f"{field}_pointers", pointers, np.int64)
+        save(f"{field}_docs", docs[order], np.int32)
+        save(f"{field}_tf", tf[order], np.uint16)
+
+        doc_count = int(np.count_nonzero(field_lengths))
+        meta["doc_count"][field] = doc_count
+        meta["avg_length"][field] = float(field_lengths.sum() / doc_count) if doc_count > 0 else 1.0
+
+    with open(os.path.join(path, "meta.json"), "w") as out_file:
+        json.dump(meta, out_file)
+
+    return num_docs
+
+
+def read_records(files: Iterable[str], language: str = "en") -> Iterator[Dict[str, Any]]:
+    # Reads entities from a Wikidata JSON dump (one entity per line), from an export of the Elasticsearch index
+    # (hits with _id and _source) or from JSON lines with the fields of the index. Compressed files are supported.
+    openhook = functools.partial(fileinput.hook_compressed, encoding="utf-8")
+    with fileinput.input(files, openhook=openhook) as lines:
+        for line in lines:
+            line = line.strip().rstrip(",")
+            if line in ("", "[", "]"):
+                continue
+
+            record = json.loads(line)
+            if "labels" in record:
+                record = _wikidata_record(record, language)
+            elif "_source" in record:
+                record = {**record["_source"], "url": record["_id"]}
+            elif "url" not in record:
+                record["url"] = record.get("id")
+
+            if record is not None and record.get("url"):
+                yield record
+
+
+def _wikidata_record(entity: Dict[str, Any], language: str) -> Optional[Dict[str, Any]]:
+    label = entity.get("labels", {}).get(language, {}).get("value")
+    aliases = [alias["value"] for alias in entity.get("aliases", {}).get(language, [])]
+    if label is None and len(aliases) == 0:
+        return None
+
+    # The number of sitelinks stands in for the frequency, if the dump has none.
+    return {
+        "url": f"http://www.wikidata.org/entity/{entity['id']}",
+        "label": label,
+        "description": entity.get("descriptions", {}).get(language, {}).get("value"),
+        "search_key": " ".join([label, *aliases] if label is not None else aliases),
+        "frequency": entity.get("frequency", len(entity.get("sitelinks", {}))),
+    }
+
+
+@click.command()
+@click.argument("dump", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("-o", "--output", required=True, type=click.Path(), help="Directory of the index")
+@click.option("-l", "--language", default="en", help="Language of labels, descriptions and aliases")
+def main(dump, output, language):
+    num_docs = build_index(read_records(dump, language), output)
+    click.echo(f"Indexed {num_docs} entities in {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,134 @@
 import abc
 import copy
 import csv
+import json
+import logging
 import os
 import re
 import sys
-from typing import List
+from typing import List, Optional, Dict, Any
 
 from elasticsearch import Elasticsearch, AuthenticationException
 
+from waka.nlp.cache import TieredCache, MISSING
+from waka.nlp.entity_index import EntityIndex
 from waka.nlp.kg import EntityMention, LinkedEntity
 from waka.nlp.text_processor import TextProcessor
 
 
+def connect_elasticsearch(logger: logging.Logger) -> Elasticsearch:
+    api_key = os.getenv("ES_API_KEY")
+    if api_key is None or api_key == "":
+        logger.error("Elasticsearch API key (ES_API_KEY) not set!")
+        sys.exit(1)
+
+    try:
+        return Elasticsearch("https://elasticsearch.srv.webis.de", api_key=api_key,
+                             retry_on_timeout=True, max_retries=10)
+    except AuthenticationException:
+        logger.error("Authentication to Elasticsearch failed!")
+        sys.exit(1)
+
+
 class EntityLinker(TextProcessor[List[EntityMention], List[LinkedEntity]], metaclass=abc.ABCMeta):
     pass
 
 
+class CandidateRetriever(metaclass=abc.ABCMeta):
+    @abc.abstractmethod
+    def search(self, queries: List[str]) -> List[Optional[List[Dict[str, Any]]]]:
+        # The Elasticsearch hits of every query, or None if the query failed.
+        pass
+
+    @abc.abstractmethod
+    def namespace(self) -> tuple:
+        # Everything besides the query that determines the hits, i.e. the index and the scoring parameters.
+        pass
+
+    def collect_metrics(self) -> List[tuple]:
+        return []
+
+
+class ElasticRetriever(CandidateRetriever):
+    def __init__(self, es_client: Elasticsearch, index_name: str, search_template: Dict[str, Any]):
+        self.es_client = es_client
+        self.index_name = index_name
+        self.search_template = search_template
+
+    def search(self, queries: List[str]) -> List[Optional[List[Dict[str, Any]]]]:
+        if len(queries) == 0:
+            return []
+
+        searches = []
+        for query in queries:
+            searches.append({"index": self.index_name})
+            search = copy.deepcopy(self.search_template)
+            search["query"]["function_score"]["query"]["query_string"]["query"] = query
+            searches.append(search)
+
+        results = self.es_client.msearch(searches=searches)
+        return [response["hits"]["hits"] if response["status"] == 200 else None
+                for response in results["responses"]]
+
+    def namespace(self) -> tuple:
+        return self.index_name, json.dumps(self.search_template, sort_keys=True)
+
+
+class LocalRetriever(CandidateRetriever):
+    def __init__(self, index: EntityIndex, alpha: float, beta: float, min_score: float, max_results: int,
+                 fuzziness: int = 0, prefix: bool = False):
+        self.index = index
+        self.alpha = alpha
+        self.beta = beta
+        self.min_score = min_score
+        self.max_results = max_results
+        self.fuzziness = fuzziness
+        self.prefix = prefix
+
+    def search(self, queries: List[str]) -> List[Optional[List[Dict[str, Any]]]]:
+        return [self.index.search(query, self.alpha, self.beta, self.min_score, self.max_results,
+                                  self.fuzziness, self.prefix)
+                for query in queries]
+
+    def namespace(self) -> tuple:
+        return (os.path.abspath(self.index.path), self.alpha, self.beta, self.min_score, self.max_results,
+                self.fuzziness, self.prefix)
+
+
+class CachedRetriever(CandidateRetriever):
+    def __init__(self, retriever: CandidateRetriever, cache: TieredCache):
+        self.retriever = retriever
+        self.cache = cache
+
+    def search(self, queries: List[str]) -> List[Optional[List[Dict[str, Any]]]]:
+        namespace = self.retriever.namespace()
+        results = {}
+        for query in dict.fromkeys(queries):
+            results[query] = self.cache.get(self.cache.key(namespace, query))
+
+        # Only the misses are sent to the wrapped retriever, every distinct query once. Failed queries are not cached.
+        missing = [query for query, hits in results.items() if hits is MISSING]
+        if len(missing) > 0:
+            for query, hits in zip(missing, self.retriever.search(missing)):
+                results[query] = hits
+                if hits is not None:
+                    self.cache.set(self.cache.key(namespace, query), hits)
+
+        return [results[query] for query in queries]
+
+    def namespace(self) -> tuple:
+        return self.retriever.namespace()
+
+    def collect_metrics(self) -> List[tuple]:
+        return self.cache.collect_metrics() + self.retriever.collect_metrics()
+
+
 class ElasticEntityLinker(EntityLinker):
-    def __init__(self, alpha=2, beta=1.6, min_score=8.0, max_results=40):
+    def __init__(self, alpha=2, beta=1.6, min_score=8.0, max_results=40, index_path: Optional[str] = None,
+                 cache_size: Optional[int] = None, cache_ttl: Optional[float] = None, cache_path: Optional[str] = None):
         super().__init__()
         self.index_name = "corpus_wikidata_20240717"
 
-        api_key = os.getenv("ES_API_KEY")
-        if api_key is None or api_key == "":
-            self.logger.error("Elasticsearch API key (ES_API_KEY) not set!")
-            sys.exit(1)
-
-        try:
-            self.es_client = Elasticsearch("https://elasticsearch.srv.webis.de", api_key=api_key,
-                                           retry_on_timeout=True, max_retries=10)
-        except AuthenticationException:
-            self.logger.error("Authentication to Elasticsearch failed!")
-            sys.exit(1)
-
         self.search_template = {
             "query": {
                 "function_score": {
@@ -57,6 +153,20 @@ class ElasticEntityLinker(EntityLinker):
             "min_score": min_score
         }
 
+        # A local index built with waka.nlp.entity_index replaces the Elasticsearch index with the same scoring.
+        index_path = index_path or os.getenv("WAKA_ENTITY_INDEX")
+        if index_path:
+            self.logger.info(f"Use the local entity index {index_path}")
+            self.retriever = LocalRetriever(EntityIndex(index_path), alpha, beta, min_score, max_results)
+        else:
+            self.retriever = ElasticRetriever(connect_elasticsearch(self.logger), self.index_name,
+                                              self.search_template)
+
+        if cache_size is not None:
+            # The same surface forms recur across documents, their candidates are only retrieved once.
+            self.retriever = CachedRetriever(self.retriever, TieredCache("entity_candidates", maxsize=cache_size,
+                                                                         ttl=cache_ttl, path=cache_path))
+
         self.country_dict = {}
 
         with open("data/countries.csv", "r") as in_file:
@@ -77,7 +187,7 @@ class ElasticEntityLinker(EntityLinker):
         super().process(text, in_data)
         linked_entities = []
         searched_entities = []
-        searches = []
+        queries = []
 
         for entity in in_data:
             if entity.url is not None:
@@ -93,19 +203,13 @@ class ElasticEntityLinker(EntityLinker):
                 ))
             else:
                 searched_entities.append(entity)
-                searches.append({"index": self.index_name})
-                search = copy.deepcopy(self.search_template)
-                search["query"]["function_score"]["query"]["query_string"]["query"] = (
-                    self.get_query(entity))
-                searches.append(search)
-
-        results = self.es_client.msearch(searches=searches)
+                queries.append(self.get_query(entity))
 
-        for response, entity in zip(results["responses"], searched_entities):
-            if response["status"] != 200:
+        for hits, entity in zip(self.retriever.search(queries), searched_entities):
+            if hits is None:
                 continue
 
-            for hit in response["hits"]["hits"]:
+            for hit in hits:
                 if "label" not in hit["_source"]:
                     continue
 
@@ -144,3 +248,6 @@ class ElasticEntityLinker(EntityLinker):
         return " || ".join(map(lambda q: re.sub(
             '(\+|\-|\=|&&|\|\||\>|\<|\!|\(|\)|\{|\}|\[|\]|\^|"|~|\*|\?|\:|\\\|\/)',
             "\\\\\\1", q), queries))
+
+    def collect_metrics(self) -> List[tuple]:
+        return self.retriever.collect_metrics()
@@ -1,20 +1,21 @@
 import abc
-import datetime
+import functools
 import logging
 import os
-import re
+from concurrent.futures import ThreadPoolExecutor, wait
 from enum import Enum
-from typing import List, Optional
+from typing import List, Optional, Callable, Any, Iterable, Literal
 
-import dateutil.parser
-import number_parser
 import spacy
 import sparknlp
 import stanza
 from flair.data import Sentence
 from flair.models import SequenceTagger
+from nltk.tokenize import PunktSentenceTokenizer
+from spacy.tokens import Doc
 from sparknlp.pretrained import PretrainedPipeline
 
+from waka.nlp import literals, devices
 from waka.nlp.kg import EntityMention
 from waka.nlp.text_processor import TextProcessor
 
@@ -24,79 +25,71 @@ class EntityType(Enum):
     LITERAL = 2
 
 
-class RDFType:
-    DECIMAL = "http://www.w3.org/2001/XMLSchema#decimal"
-    DATETIME = "http://www.w3.org/2001/XMLSchema#dateTime"
-
-
 class EntityRecognizer(TextProcessor, metaclass=abc.ABCMeta):
     def __init__(self):
         super().__init__()
-        self.decimal_types = {"PERCENT", "MONEY", "QUANTITY", "CARDINAL", "ORDINAL"}
-        self.date_types = {"DATE", "TIME"}
+        self.decimal_types = literals.DECIMAL_TYPES
+        self.date_types = literals.DATE_TYPES
 
     def parse_decimal(self, text: str) -> Optional[str]:
-        decimal = None
-        try:
-            decimal = float(re.sub("[^0-9.\-–]", "", text))
-        except ValueError:
-            pass
-
-        if decimal is None:
-            decimal = number_parser.parse_number(text)
-
-        if decimal is None:
-            decimal = number_parser.parse_ordinal(text)
-
-        if decimal is not None:
-            url = f"{decimal:+0.0f}^^{RDFType.DECIMAL}"
-            return url
-        else:
+        url = literals.normalize_decimal(text)
+        if url is None:
             self.logger.warning(f"Can't parse \"{text}\" as decimal!")
 
-        return None
+        return url
 
     def parse_datetime(self, text: str) -> Optional[str]:
-        try:
-            date = dateutil.parser.parse(text, default=datetime.datetime(1, 1, 1))
-            url = f"{date.strftime('%Y-%m-%dT%H:%M:%SZ')}^^{RDFType.DATETIME}"
-            return url
-        except ValueError:
+        url = literals.normalize_datetime(text)
+        if url is None:
             self.logger.warning(f"Can't parse \"{text}\" as datetime!")
 
-        return None
+        return url
+
+    def normalize_literals(self, entities: List[EntityMention]) -> List[EntityMention]:
+        for mention in literals.normalize_mentions(entities, self.decimal_types, self.date_types):
+            literal_type = "decimal" if mention.e_type in self.decimal_types else "datetime"
+            self.logger.warning(f"Can't parse \"{mention.text}\" as {literal_type}!")
+
+        return entities
 
 
 class SpacyNER(EntityRecognizer):
 
-    def __init__(self):
+    def __init__(self, batch_size: int = 32, n_process: int = 1, exclude: Iterable[str] = ("parser",)):
         super().__init__()
-        self.nlp = spacy.load("en_core_web_trf")
+        # Only POS tags, lemmas and entities are used, so the dependency parser is not loaded by default.
+        # It has to be kept for _add_noun_phrases, since noun chunks depend on the parse.
+        self.nlp = spacy.load("en_core_web_trf", exclude=list(exclude))
+        self.batch_size = batch_size
+        self.n_process = n_process
 
     def process(self, text: str, in_data: str) -> List[EntityMention]:
         super().process(text, in_data)
+        return self._get_entities(text, self.nlp(text))
+
+    def process_batch(self, texts: List[str], in_data: List[str]) -> List[List[EntityMention]]:
+        docs = self.nlp.pipe(texts, batch_size=self.batch_size, n_process=self.n_process)
+        return [self._get_entities(text, doc) for text, doc in zip(texts, docs)]
+
+    def model_version(self) -> tuple:
+        return self.nlp.meta["name"], self.nlp.meta["version"]
+
+    def _get_entities(self, text: str, doc: Doc) -> List[EntityMention]:
         entities = []
-        doc = self.nlp(text)
 
         self._add_nouns(text, doc, entities)
         # self._add_noun_phrases(doc, entities)
 
         for entity in doc.ents:
-            url = None
-            if entity.label_ in self.decimal_types:
-                url = self.parse_decimal(entity.text)
-            elif entity.label_ in self.date_types:
-                url = self.parse_datetime(entity.text)
-
             entities.append(EntityMention(
-                url=url,
+                url=None,
                 start_idx=entity.start_char,
                 end_idx=entity.end_char,
                 text=entity.text,
                 e_type=entity.label_,
             ))
 
-        return entities
+        return self.normalize_literals(entities)
 
     @staticmethod
     def _add_nouns(text, doc, entities):
@@ -183,97 +176,128 @@ class SpacyNER(EntityRecognizer):
 
 
 class StanzaNER(EntityRecognizer):
+    NOUN_TAGS = {"NOUN", "PROPN"}
+    CHUNK_TAGS = {"ADJ", "NUM", "NOUN", "PROPN"}
 
-    def __init__(self):
+    def __init__(self, noun_phrases: Literal["constituency", "chunker"] = "constituency"):
         super().__init__()
-        self.nlp = stanza.Pipeline(lang="en", processors="tokenize,mwt,pos,ner,constituency")
-        self.decimal_types = {"PERCENT", "MONEY", "QUANTITY", "CARDINAL", "ORDINAL"}
-        self.date_types = {"DATE", "TIME"}
+        # The constituency parser is the most expensive stanza processor. The chunker finds noun phrases from
+        # POS tags only, so the parser is not loaded at all in that mode.
+        self.noun_phrases = noun_phrases
+        if noun_phrases == "constituency":
+            self.nlp = stanza.Pipeline(lang="en", processors="tokenize,mwt,pos,ner,constituency")
+        elif noun_phrases == "chunker":
+            self.nlp = stanza.Pipeline(lang="en", processors="tokenize,mwt,pos,ner")
+        else:
+            raise ValueError(f"Unknown noun phrase mode \"{noun_phrases}\"")
 
-    def extract_noun_phrases(self, text, sentence, constituency):
-        tree_queue = []
-        phrase_list = []
+    def model_version(self) -> tuple:
+        # The default models of stanza are tied to the version of the package.
+        return "stanza", stanza.__version__, self.noun_phrases
 
+    def extract_noun_phrases(self, text, sentence, constituency):
         noun_phrases = []
         word_index = {w.id: w for w in sentence.words}
 
-        for child in constituency.children:
-            tree_queue.append(child)
+        # Depth-first traversal with an explicit stack, None marks the end of an NP. Instead of updating every open
+        # phrase on each word, the offsets of words are recorded once and a phrase reads its span when it is closed.
+        tree_stack = list(reversed(constituency.children))
+        phrase_stack = []
+        word_starts = []
+        word_ends = []
 
         word_id = 0
 
         parent_label = None
-        while len(tree_queue) > 0:
-            constituency = tree_queue.pop(0)
+        while len(tree_stack) > 0:
+            constituency = tree_stack.pop()
 
             if constituency is None:
-                entity = phrase_list.pop(0)
-                if entity.start_idx is not None and entity.end_idx is not None:
-                    noun_phrases.append(entity)
+                first_word = phrase_stack.pop()
+                if first_word < len(word_starts):
+                    start_idx = word_starts[first_word]
+                    end_idx = word_ends[-1]
+                    noun_phrases.append(EntityMention(text=text[start_idx:end_idx], start_idx=start_idx,
+                                                      end_idx=end_idx, url=None, e_type="NP"))
                 parent_label = None
                 continue
 
             if len(constituency.children) == 0:
                 word_id += 1
 
-                if len(phrase_list) > 0 and parent_label != "DT":
-                    for e in phrase_list:
-                        if e.text == "":
-                            e.start_idx = word_index[word_id].start_char
-
-                        e.end_idx = word_index[word_id].end_char
-                        e.text = text[e.start_idx: e.end_idx]
+                # Leading determiners are not part of a phrase.
+                if parent_label != "DT":
+                    word_starts.append(word_index[word_id].start_char)
+                    word_ends.append(word_index[word_id].end_char)
 
             if constituency.label == "NP":
-                phrase_list.insert(0, EntityMention(text="", start_idx=None, end_idx=None, url=None, e_type="NP"))
-                tree_queue.insert(0, None)
+                phrase_stack.append(len(word_starts))
+                tree_stack.append(None)
 
-            for child in reversed(constituency.children):
-                tree_queue.insert(0, child)
+            tree_stack.extend(reversed(constituency.children))
 
             parent_label = constituency.label
 
         return noun_phrases
 
+    def chunk_noun_phrases(self, text, sentence):
+        noun_phrases = []
+        chunk = []
+
+        for word in [*sentence.words, None]:
+            if word is not None and word.upos in self.CHUNK_TAGS:
+                chunk.append(word)
+                continue
+
+            # A chunk is a run of adjectives, numbers and nouns, which has to end with a noun.
+            while len(chunk) > 0 and chunk[-1].upos not in self.NOUN_TAGS:
+                chunk.pop()
+
+            if len(chunk) > 0:
+                start_idx = chunk[0].start_char
+                end_idx = chunk[-1].end_char
+                noun_phrases.append(EntityMention(text=text[start_idx:end_idx], start_idx=start_idx,
+                                                  end_idx=end_idx, url=None, e_type="NP"))
+            chunk = []
+
+        return noun_phrases
+
     def process(self, text: str, in_data: str) -> List[EntityMention]:
         super().process(text, in_data)
         entities = []
         doc = self.nlp(text)
 
         for sent in doc.sentences:
-            entities.extend(self.extract_noun_phrases(text, sent, sent.constituency))
+            if self.noun_phrases == "chunker":
+                entities.extend(self.chunk_noun_phrases(text, sent))
+            else:
+                entities.extend(self.extract_noun_phrases(text, sent, sent.constituency))
 
         for entity in doc.ents:
-            url = None
-            if entity.type in self.decimal_types:
-                url = self.parse_decimal(entity.text)
-            elif entity.type in self.date_types:
-                url = self.parse_datetime(entity.text)
-
             entities.append(EntityMention(
-                url=url,
+                url=None,
                 start_idx=entity.start_char,
                 end_idx=entity.end_char,
                 text=entity.text,
                 e_type=entity.type,
             ))
 
-        return entities
+        return self.normalize_literals(entities)
 
 
 class SparkNLPNER(EntityRecognizer):
 
-    def __init__(self):
+    def __init__(self, device: Optional[str] = None):
         super().__init__()
         os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
         logging.getLogger("py4j").setLevel(level=logging.WARN)
-        self.spark = sparknlp.start(gpu=True)
+        self.spark = sparknlp.start(gpu=devices.select_device(device).startswith("cuda"))
         # self.spark.sparkContext.setLogLevel("WARN")
         self.nlp_onto = PretrainedPipeline("onto_recognize_entities_lg", "en")
         self.nlp_dl = PretrainedPipeline("recognize_entities_dl", "en")
 
-        self.decimal_types = {"PERCENT", "MONEY", "QUANTITY", "CARDINAL", "ORDINAL"}
-        self.date_types = {"DATE", "TIME"}
+    def model_version(self) -> tuple:
+        return "onto_recognize_entities_lg", "recognize_entities_dl"
 
     def process(self, text: str, in_data: str) -> List[EntityMention]:
         super().process(text, in_data)
@@ -288,62 +312,187 @@ class SparkNLPNER(EntityRecognizer):
         for result in results:
             for annotation in result["entities"]:
                 entity_type = annotation.metadata.getOrDefault("entity", None)
-                url = None
-                if entity_type in self.decimal_types:
-                    url = self.parse_decimal(annotation.result)
-                elif entity_type in self.date_types:
-                    url = self.parse_datetime(annotation.result)
-
                 entities.append(EntityMention(
-                    url=url,
+                    url=None,
                     start_idx=annotation.begin,
                     end_idx=annotation.end + 1,
                     text=annotation.result,
                     e_type=entity_type))
 
-        return entities
+        return self.normalize_literals(entities)
 
 
 class FlairNER(EntityRecognizer):
+    MODEL = "flair/ner-english"
 
-    def __init__(self):
+    def __init__(self, mini_batch_size: int = 32):
         super().__init__()
-        self.tagger = SequenceTagger.load("flair/ner-english")
+        self.tagger = SequenceTagger.load(self.MODEL)
+        self.mini_batch_size = mini_batch_size
+        self.sentence_tokenizer = PunktSentenceTokenizer()
 
     def process(self, text: str, in_data: str) -> List[EntityMention]:
         super().process(text, in_data)
-        entities = []
-
-        sentence = Sentence(text)
-        self.tagger.predict(sentence)
-
-        for entity in sentence.get_spans("ner"):
-            entities.append(EntityMention(
-                url=None,
-                start_idx=entity.start_position,
-                end_idx=entity.end_position,
-                text=entity.text,
-                e_type=entity.get_label().value
-            ))
+        return self.process_batch([text], [in_data])[0]
+
+    def process_batch(self, texts: List[str], in_data: List[str]) -> List[List[EntityMention]]:
+        # Tagging sentences instead of whole documents keeps sequences short, and the sentences of all texts are
+        # predicted together in mini batches.
+        sentences = []
+        sentence_offsets = []
+        for i, text in enumerate(texts):
+            for start, end in self.sentence_tokenizer.span_tokenize(text):
+                sentences.append(Sentence(text[start:end]))
+                sentence_offsets.append((i, start))
+
+        self.tagger.predict(sentences, mini_batch_size=self.mini_batch_size)
+
+        entities = [[] for _ in texts]
+        for sentence, (i, offset) in zip(sentences, sentence_offsets):
+            for entity in sentence.get_spans("ner"):
+                entities[i].append(EntityMention(
+                    url=None,
+                    start_idx=offset + entity.start_position,
+                    end_idx=offset + entity.end_position,
+                    text=entity.text,
+                    e_type=entity.get_label().value
+                ))
 
         return entities
 
+    def model_version(self) -> tuple:
+        return self.MODEL,
+
 
 class EnsembleNER(EntityRecognizer):
 
-    def __init__(self):
+    def __init__(self, concurrent: bool = False, member_timeout: Optional[float] = None, min_agreement: int = 1,
+                 overlap: Literal["keep", "prune"] = "keep",
+                 noun_phrases: Literal["constituency", "chunker"] = "constituency", spacy_batch_size: int = 32,
+                 spacy_n_process: int = 1, flair_mini_batch_size: int = 32):
         super().__init__()
-        self.ner = [
-            # SparkNLPNER(),
-            StanzaNER(),
-            SpacyNER(),
-            FlairNER()
+        recognizers = [
+            # SparkNLPNER,
+            functools.partial(StanzaNER, noun_phrases=noun_phrases),
+            functools.partial(SpacyNER, batch_size=spacy_batch_size, n_process=spacy_n_process),
+            functools.partial(FlairNER, mini_batch_size=flair_mini_batch_size)
         ]
 
+        # The models of the recognizers are independent of each other and are loaded in parallel.
+        with ThreadPoolExecutor(max_workers=len(recognizers), thread_name_prefix="ensemble-ner-load") as executor:
+            self.ner = list(executor.map(lambda recognizer: recognizer(), recognizers))
+
+        # The recognizers spend most of their time in native model code, so threads run them in parallel. A timeout
+        # can only be enforced for recognizers running in threads, so it implies concurrent execution.
+        self.member_timeout = member_timeout
+        self.executor = None
+        if concurrent or member_timeout is not None:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.ner), thread_name_prefix="ensemble-ner")
+        self.running = {}
+
+        if overlap not in ("keep", "prune"):
+            raise ValueError(f"Unknown overlap mode \"{overlap}\"")
+        self.min_agreement = min_agreement
+        self.overlap = overlap
+
     def process(self, text: str, in_data: str) -> List[EntityMention]:
-        entities = set()
+        return self.merge(self._run_members(lambda ner: ner.process(text, in_data)))
+
+    def process_batch(self, texts: List[str], in_data: List[str]) -> List[List[EntityMention]]:
+        member_results = self._run_members(lambda ner: ner.process_batch(texts, in_data))
+        return [self.merge([member_entities[i] for member_entities in member_results]) for i in range(len(texts))]
+
+    def model_version(self) -> tuple:
+        return tuple(ner.model_version() for ner in self.ner)
+
+    def merge(self, member_entities: List[List[EntityMention]]) -> List[EntityMention]:
+        literal_types = self.decimal_types | self.date_types
+
+        # Exact duplicates are merged in a span index, which also counts how many recognizers found a span. A
+        # mention with a parsed literal is preferred over the same span without one, otherwise the first wins.
+        spans = {}
+        for member, entities in enumerate(member_entities):
+            for entity in entities:
+                key = (entity.start_idx, entity.end_idx)
+                span = spans.get(key)
+                if span is None:
+                    spans[key] = [entity, {member}]
+                    continue
+
+                span[1].add(member)
+                if span[0].url is None and entity.url is not None:
+                    span[0] = entity
+
+        merged = []
+        candidates = []
+        for (start_idx, end_idx), (entity, members) in spans.items():
+            # Literals are kept regardless of agreement, since only a single recognizer may normalise them.
+            if entity.e_type in literal_types or start_idx is None or end_idx is None:
+                merged.append(entity)
+            elif len(members) >= self.min_agreement:
+                candidates.append((entity, len(members)))
+
+        if self.overlap == "keep":
+            merged.extend(entity for entity, _ in candidates)
+        else:
+            for group in _overlap_groups(candidates):
+                merged.extend(_prune_overlaps(group))
+
+        return sorted(merged, key=lambda e: (e.start_idx is None, e.start_idx or 0, e.end_idx or 0))
+
+    def _run_members(self, call: Callable[[EntityRecognizer], Any]) -> List[Any]:
+        if self.executor is None:
+            return [call(ner) for ner in self.ner]
+
+        futures = {}
+        for i, ner in enumerate(self.ner):
+            # A recognizer that timed out earlier may still be busy, it is not called again until it is done.
+            running = self.running.get(i)
+            if running is not None and not running.done():
+                self.logger.warning(f"{ner.__class__.__name__} is still busy with a previous text, skip it")
+                continue
+
+            futures[i] = self.executor.submit(call, ner)
+            self.running[i] = futures[i]
+
+        wait(futures.values(), timeout=self.member_timeout)
+
+        # Results are collected in member order, so the merge does not depend on which recognizer finished first.
+        results = []
+        for i, future in futures.items():
+            if not future.done():
+                self.logger.warning(f"{self.ner[i].__class__.__name__} timed out after {self.member_timeout}s, "
+                                    f"drop its entities")
+                continue
+
+            results.append(future.result())
+
+        return results
+
+
+def _overlap_groups(candidates: List[tuple]) -> List[List[tuple]]:
+    # Sorted by start, a span belongs to the current group as long as it does not start after the group ends. Like
+    # EntityMention.overlaps_with, spans that touch count as overlapping.
+    groups = []
+    group_end = None
+    for candidate in sorted(candidates, key=lambda c: (c[0].start_idx, c[0].end_idx)):
+        entity = candidate[0]
+        if group_end is None or entity.start_idx > group_end:
+            groups.append([])
+            group_end = entity.end_idx
+
+        groups[-1].append(candidate)
+        group_end = max(group_end, entity.end_idx)
+
+    return groups
+
 
-        for ner in self.ner:
-            entities = entities.union(ner.process(text, in_data))
+def _prune_overlaps(group: List[tuple]) -> List[EntityMention]:
+    # Within a group of overlapping spans, the spans with most votes and then the longest spans are kept as long as
+    # they don't overlap an already kept span.
+    kept = []
+    for entity, _ in sorted(group, key=lambda c: (-c[1], c[0].start_idx - c[0].end_idx, c[0].start_idx)):
+        if not any(entity.overlaps_with(k) for k in kept):
+            kept.append(entity)
 
-        return list(entities)
+    return kept
@@ -0,0 +1,136 @@
+import bisect
+import copy
+import difflib
+import math
+from dataclasses import dataclass, field
+from typing import List, Tuple, Optional, Dict
+
+from waka.nlp.chunking import DocumentChunker, shift_offsets
+from waka.nlp.kg import Triple, UniqueEntity, EntityMention
+
+Span = Tuple[int, int]
+
+
+@dataclass
+class Session:
+    text: str
+    entities: List[UniqueEntity] = field(default_factory=list)
+    triples: List[Triple] = field(default_factory=list)
+
+
+@dataclass
+class TextDiff:
+    # Start, end and offset delta of every sentence of the old text that is unchanged in the new text.
+    unchanged: List[Tuple[int, int, int]]
+    # Spans of the new text that have to be processed again.
+    changed: List[Span]
+
+    def map_span(self, start: Optional[int], end: Optional[int]) -> Optional[Span]:
+        if start is None or end is None:
+            return None
+
+        # Only spans within an unchanged sentence are moved, everything else is found again in the changed regions.
+        i = bisect.bisect_right(self.unchanged, (start, math.inf, 0)) - 1
+        if i < 0 or end > self.unchanged[i][1]:
+            return None
+
+        delta = self.unchanged[i][2]
+        return start + delta, end + delta
+
+
+def diff_texts(old_text: str, new_text: str, splitter: DocumentChunker) -> TextDiff:
+    old_spans = splitter.sentence_spans(old_text)
+    new_spans = splitter.sentence_spans(new_text)
+    matcher = difflib.SequenceMatcher(a=[old_text[s:e] for s, e in old_spans],
+                                      b=[new_text[s:e] for s, e in new_spans],
+                                      autojunk=False)
+
+    unchanged = []
+    changed = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            for (old_start, old_end), (new_start, _) in zip(old_spans[i1:i2], new_spans[j1:j2]):
+                unchanged.append((old_start, old_end, new_start - old_start))
+        elif j2 > j1:
+            # Consecutive changed sentences are processed as one region, so they keep their context.
+            changed.append((new_spans[j1][0], new_spans[j2 - 1][1]))
+
+    return TextDiff(unchanged=unchanged, changed=changed)
+
+
+def carry_over(session: Session, diff: TextDiff, text: str) -> Tuple[List[UniqueEntity], List[Triple]]:
+    # Copies of the entities and triples of unchanged sentences, moved to their offsets in the new text.
+    entities = []
+    for entity in session.entities:
+        mentions = [_moved(mention, diff) for mention in entity.mentions]
+        mentions = [mention for mention in mentions if mention is not None]
+        if len(mentions) > 0:
+            entity = copy.copy(entity)
+            entity.mentions = mentions
+            entities.append(entity)
+
+    triples = []
+    for triple in session.triples:
+        arguments = []
+        for argument in (triple.subject, triple.object):
+            if argument.start_idx is None:
+                # Arguments that couldn't be aligned to the text are kept as long as their text is still there.
+                arguments.append(argument if argument.text and argument.text in text else None)
+            else:
+                arguments.append(_moved(argument, diff))
+
+        if arguments[0] is not None and arguments[1] is not None:
+            triple = copy.copy(triple)
+            triple.subject, triple.object = arguments
+            triples.append(triple)
+
+    return entities, triples
+
+
+def merge(entities: List[UniqueEntity], triples: List[Triple],
+          region_results: List[Tuple[int, List[UniqueEntity], List[Triple]]]) \
+        -> Tuple[List[UniqueEntity], List[Triple]]:
+    entities_by_url: Dict[Optional[str], UniqueEntity] = {entity.url: entity for entity in entities}
+    region_triples = []
+
+    for offset, new_entities, new_triples in region_results:
+        shifted = set()
+        for item in [*(new_entities or []), *(new_triples or [])]:
+            shift_offsets(item, offset, shifted)
+
+        for entity in new_entities or []:
+            existing = entities_by_url.get(entity.url)
+            if existing is None:
+                entities_by_url[entity.url] = entity
+                continue
+
+            existing.mentions = existing.mentions + [m for m in entity.mentions if m not in existing.mentions]
+            if entity.score is not None and (existing.score is None or entity.score > existing.score):
+                existing.score = entity.score
+
+        region_triples.extend(new_triples or [])
+
+    # Unaligned triples that were extracted again from a changed region are only kept once.
+    region_keys = {_text_key(triple) for triple in region_triples}
+    triples = [triple for triple in triples
+               if not (_unaligned(triple) and _text_key(triple) in region_keys)]
+
+    return list(entities_by_url.values()), triples + region_triples
+
+
+def _moved(mention: EntityMention, diff: TextDiff) -> Optional[EntityMention]:
+    span = diff.map_span(mention.start_idx, mention.end_idx)
+    if span is None:
+        return None
+
+    mention = copy.copy(mention)
+    mention.start_idx, mention.end_idx = span
+    return mention
+
+
+def _unaligned(triple: Triple) -> bool:
+    return triple.subject.start_idx is None or triple.object.start_idx is None
+
+
+def _text_key(triple: Triple) -> tuple:
+    return triple.subject.text, triple.predicate.text, triple.object.text
@@ -32,7 +32,7 @@ class EntityMention(Resource):
     e_type: Optional[str]
 
     def __hash__(self):
-        return hash(f"{self.start_idx}:{self.end_idx}")
+        return hash((self.start_idx, self.end_idx))
 
     def __eq__(self, other):
         if isinstance(other, LinkedEntity):
@@ -98,7 +98,7 @@ class LinkedEntity(EntityMention):
     score: Optional[float]
 
     def __hash__(self):
-        return hash(f"{self.start_idx}:{self.end_idx}:{self.url}")
+        return hash((self.start_idx, self.end_idx, self.url))
 
     def __eq__(self, other):
         if isinstance(other, LinkedEntity):
@@ -1,18 +1,29 @@
 from __future__ import annotations
 
+import asyncio
 import copy
+import functools
 import logging
-from typing import List, Optional, Dict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Dict, AsyncIterator, Tuple
 
+import cachetools
 import numpy as np
 from Levenshtein import distance
 
+from waka.nlp import metrics, incremental
+from waka.nlp.cache import SentenceCachedProcessor
+from waka.nlp.chunking import ChunkedProcessor, DocumentChunker
 from waka.nlp.entity_linking import ElasticEntityLinker
 from waka.nlp.entity_recognition import EnsembleNER
 from waka.nlp.kg import EntityMention, Triple, KnowledgeGraph, UniqueEntity
-from waka.nlp.relation_extraction import MRebelExtractor
+from waka.nlp.model_server import ModelServer, ModelClient
+from waka.nlp.relation_extraction import MRebelExtractor, MRebelModel
 from waka.nlp.relation_linking import ElasticRelationLinker
-from waka.nlp.semantics import TripleScorer, WikidataFilter, EntitySentenceBert, BartMNLI
+from waka.nlp.semantics import TripleScorer, WikidataFilter, EntitySentenceBert, BartMNLI, SentenceBert, \
+    SentenceEncoder, NLIModel
 from waka.nlp.text_processor import Pipeline
 
 
@@ -52,15 +63,15 @@ class KGFactory:
 
     def build(self) -> KnowledgeGraph:
         self.kg = KnowledgeGraph(text=self.text, triples=[], entities=[], entity_mentions=[])
-        entities_by_mention = self._construct_entity_by_mention_index()
+        entities_by_mention, entities_by_span = self._construct_entity_indices()
 
         triple_sets = []
 
         for triple in self.triples:
             triple_candidates = []
 
-            sub_entities = self._get_entities_for_mention(triple.subject.text, entities_by_mention)
-            obj_entities = self._get_entities_for_mention(triple.object.text, entities_by_mention)
+            sub_entities = self._get_entities_for_argument(triple.subject, entities_by_span, entities_by_mention)
+            obj_entities = self._get_entities_for_argument(triple.object, entities_by_span, entities_by_mention)
 
             for subj in sub_entities:
                 for obj in obj_entities:
@@ -85,7 +96,10 @@ class KGFactory:
                 triple_candidates.extend(triple_set)
 
             for triple_scorer in self.triple_scorer:
+                start = time.time()
                 triple_candidates = triple_scorer.score(self.text, triple_candidates)
+                metrics.registry.observe("waka_scorer_seconds", time.time() - start,
+                                         scorer=triple_scorer.__class__.__name__)
 
         for triple_set in triple_sets:
             try:
@@ -191,23 +205,53 @@ class KGFactory:
 
         return list(conflicts)
 
-    def _construct_entity_by_mention_index(self) -> Dict[str, List[UniqueEntity]]:
+    def _construct_entity_indices(self) \
+            -> Tuple[Dict[str, List[UniqueEntity]], Dict[Tuple[int, int], List[UniqueEntity]]]:
         entities_by_mention = {}
+        entities_by_span = {}
 
         for entity in self.unique_entities:
             for mention in entity.mentions:
+                span = (mention.start_idx, mention.end_idx)
                 if mention.text not in entities_by_mention:
                     entities_by_mention[mention.text] = []
 
+                if span not in entities_by_span:
+                    entities_by_span[span] = []
+
+                entity_copy = None
                 if entity not in entities_by_mention[mention.text]:
                     entity_copy = copy.deepcopy(entity)
                     entity_copy.score = mention.score
                     entities_by_mention[mention.text].append(entity_copy)
 
+                if entity not in entities_by_span[span]:
+                    if entity_copy is None:
+                        entity_copy = copy.deepcopy(entity)
+                        entity_copy.score = mention.score
+                    entities_by_span[span].append(entity_copy)
+
         for mention, entity in entities_by_mention.items():
             entities_by_mention[mention] = sorted(entities_by_mention[mention], key=lambda e: -e.score)
 
-        return entities_by_mention
+        for span, entity in entities_by_span.items():
+            entities_by_span[span] = sorted(entities_by_span[span], key=lambda e: -e.score)
+
+        return entities_by_mention, entities_by_span
+
+    @staticmethod
+    def _get_entities_for_argument(argument: EntityMention,
+                                   entities_by_span: Dict[Tuple[int, int], List[UniqueEntity]],
+                                   entities_by_mention: Dict[str, List[UniqueEntity]]) \
+            -> List[UniqueEntity]:
+        # Arguments aligned to the text are joined with the entities linked at exactly their span. Unaligned
+        # arguments and spans without linked entities fall back to matching the text.
+        if argument.start_idx is not None:
+            entities = entities_by_span.get((argument.start_idx, argument.end_idx))
+            if entities:
+                return list(entities)
+
+        return KGFactory._get_entities_for_mention(argument.text, entities_by_mention)
 
     @staticmethod
     def _get_entities_for_mention(mention: str,
@@ -230,33 +274,92 @@ class KGFactory:
 
 
 class KGConstructor:
-
-    def __init__(self, scorer=None):
+    WARMUP_TEXT = ("The Bauhaus-Universität Weimar is a university located in Weimar, Germany. "
+                   "In 1919 the school was renamed Bauhaus by its new director Walter Gropius.")
+
+    def __init__(self, scorer=None, el_workers: int = 1, rl_workers: int = 1, stage_parallel: bool = False,
+                 batch_size: int = 1, batch_timeout_ms: float = 0.0, transport: str = "pickle",
+                 ner_concurrent: bool = False, ner_timeout: Optional[float] = None, ner_min_agreement: int = 1,
+                 ner_overlap: str = "keep", ner_noun_phrases: str = "constituency", ner_spacy_batch_size: int = 32,
+                 ner_spacy_processes: int = 1, ner_flair_batch_size: int = 32, chunk_size: Optional[int] = None,
+                 chunk_overlap: int = 1, decoding: str = "beam", cache_size: Optional[int] = None,
+                 cache_path: Optional[str] = None, cache_version: Optional[str] = None,
+                 candidate_cache_size: Optional[int] = None, candidate_cache_ttl: Optional[float] = None,
+                 candidate_cache_path: Optional[str] = None, max_sessions: int = 1000, session_ttl: float = 3600.0,
+                 model_server: bool = False,
+                 model_batch_size: int = 64, model_max_latency_ms: float = 5.0, warmup_text: Optional[str] = None):
         logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
         self.logger = logging.getLogger(KGConstructor.__name__)
         self.logger.setLevel(logging.DEBUG)
-        self.er = EnsembleNER
+
+        # With model servers every neural model is loaded once in its own process, and the pipeline workers and the
+        # scorers send their inputs there, where the inputs of concurrent requests are batched.
+        self.model_servers: List[ModelServer] = []
+        entity_encoder = None
+        relation_generator = None
+        self.scorer_models = {}
+        if model_server:
+            servers = functools.partial(self._start_model_server, max_batch_size=model_batch_size,
+                                        max_latency_ms=model_max_latency_ms)
+            entity_encoder = servers(
+                "entity-encoder", functools.partial(SentenceEncoder, "models/all-distilroberta-v1"))
+            relation_generator = servers("mrebel", MRebelModel)
+            if scorer is None or BartMNLI in scorer:
+                self.scorer_models[BartMNLI] = servers("nli", NLIModel)
+            if scorer is not None and SentenceBert in scorer:
+                self.scorer_models[SentenceBert] = servers(
+                    "sentence-encoder", functools.partial(SentenceEncoder, "paraphrase-mpnet-base-v2"))
+
+        self.er = functools.partial(EnsembleNER, concurrent=ner_concurrent, member_timeout=ner_timeout,
+                                    min_agreement=ner_min_agreement, overlap=ner_overlap,
+                                    noun_phrases=ner_noun_phrases, spacy_batch_size=ner_spacy_batch_size,
+                                    spacy_n_process=ner_spacy_processes, flair_mini_batch_size=ner_flair_batch_size)
         self.el = ElasticEntityLinker
-        self.re = MRebelExtractor
+        self.re = functools.partial(MRebelExtractor, decoding=decoding, model=relation_generator)
         self.rl = ElasticRelationLinker
 
-        self.el_pipeline = Pipeline[List[EntityMention]]()
+        if candidate_cache_size is not None:
+            # Candidates of recurring mentions and predicates are cached by query, so Elasticsearch only gets misses.
+            self.el = functools.partial(ElasticEntityLinker, cache_size=candidate_cache_size,
+                                        cache_ttl=candidate_cache_ttl, cache_path=candidate_cache_path)
+            self.rl = functools.partial(ElasticRelationLinker, cache_size=candidate_cache_size,
+                                        cache_ttl=candidate_cache_ttl, cache_path=candidate_cache_path)
+
+        if chunk_size is not None:
+            # Long documents are split into overlapping chunks for recognition and extraction, the entity linker
+            # and the scorers work on the merged mentions of the whole text.
+            self.er = functools.partial(ChunkedProcessor, self.er, max_chars=chunk_size, overlap=chunk_overlap)
+            self.re = functools.partial(ChunkedProcessor, self.re, max_chars=chunk_size, overlap=chunk_overlap)
+
+        if cache_size is not None:
+            # Recognition and extraction results are cached per sentence, so a resubmitted text with one revised
+            # sentence only runs the models on that sentence.
+            self.er = functools.partial(SentenceCachedProcessor, self.er, maxsize=cache_size, path=cache_path,
+                                        version=cache_version)
+            self.re = functools.partial(SentenceCachedProcessor, self.re, maxsize=cache_size, path=cache_path,
+                                        version=cache_version)
+
+        self.el_pipeline = Pipeline[List[EntityMention]](
+            num_workers=el_workers, stage_parallel=stage_parallel,
+            batch_size=batch_size, batch_timeout_ms=batch_timeout_ms, transport=transport, name="el-pipeline")
 
         self.el_pipeline.add_processor(self.er)
         self.el_pipeline.add_processor(self.el)
-        self.el_pipeline.add_processor(EntitySentenceBert)
+        self.el_pipeline.add_processor(functools.partial(EntitySentenceBert, model=entity_encoder))
 
-        self.rl_pipeline = Pipeline[List[Triple]]()
+        self.rl_pipeline = Pipeline[List[Triple]](
+            num_workers=rl_workers, stage_parallel=stage_parallel,
+            batch_size=batch_size, batch_timeout_ms=batch_timeout_ms, transport=transport, name="rl-pipeline")
         self.rl_pipeline.add_processor(self.re)
         self.rl_pipeline.add_processor(self.rl)
 
-        if scorer is None:
-            self.triple_scorer = [
-                WikidataFilter(),
-                BartMNLI()
-            ]
-        else:
-            self.triple_scorer = [x() for x in scorer]
+        # Graph building runs the triple scorers in this process, keep it off the event loop for async callers.
+        self.build_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kg-build")
+
+        # Pipeline results of the last text of every editing session, for incremental reconstruction.
+        self.sessions = cachetools.TTLCache(maxsize=max_sessions, ttl=session_ttl)
+        self.sessions_lock = threading.Lock()
+        self.sentence_splitter = DocumentChunker()
 
         try:
             self.el_pipeline.start()
@@ -264,25 +367,216 @@ class KGConstructor:
         except Exception as e:
             self.logger.error(e.with_traceback(None))
 
-    def construct(self, text: str) -> KnowledgeGraph:
+        # The scorers are loaded while the pipeline processes load their models. Since loading is the first task of
+        # the build executor, graphs are only built once the scorers are available.
+        self.triple_scorer = None
+        self.scorer_loading = self.build_executor.submit(self._load_scorer, scorer)
+
+        self.warm = threading.Event()
+        if warmup_text is None:
+            self.warm.set()
+        else:
+            threading.Thread(target=self._warm_up, args=(warmup_text,), name="kg-warmup", daemon=True).start()
+
+    def _start_model_server(self, name: str, model, max_batch_size: int, max_latency_ms: float) -> ModelClient:
+        server = ModelServer(model, max_batch_size=max_batch_size, max_latency_ms=max_latency_ms,
+                             name=f"model-server-{name}")
+        server.start()
+        self.model_servers.append(server)
+        return server.client()
+
+    def _load_scorer(self, scorer) -> None:
+        if scorer is None:
+            scorer = [WikidataFilter, BartMNLI]
+
+        self.triple_scorer = [x(model=self.scorer_models[x]) if x in self.scorer_models else x() for x in scorer]
+
+    def _warm_up(self, text: str) -> None:
+        # A first pass initialises CUDA kernels and lazily loaded resources before the first real request.
+        try:
+            self.el_pipeline.wait_ready()
+            self.rl_pipeline.wait_ready()
+            start = time.time()
+            self.construct(text)
+            self.logger.info(f"Warm-up done [{time.time() - start:.4f}s]")
+        except Exception as e:
+            self.logger.error(f"Warm-up failed: {e}")
+        finally:
+            self.warm.set()
+
+    def is_ready(self) -> bool:
+        return (self.el_pipeline.is_ready()
+                and self.rl_pipeline.is_ready()
+                and all(server.ready.is_set() and server.is_alive() for server in self.model_servers)
+                and self.scorer_loading.done()
+                and self.scorer_loading.exception() is None
+                and self.warm.is_set())
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        try:
+            self.scorer_loading.result(remaining())
+        except Exception:
+            return False
+
+        for server in self.model_servers:
+            if not server.ready.wait(remaining()):
+                return False
+
+        return (self.el_pipeline.wait_ready(remaining())
+                and self.rl_pipeline.wait_ready(remaining())
+                and self.warm.wait(remaining()))
+
+    def construct(self, text: str, decoding: Optional[str] = None) -> KnowledgeGraph:
         self.logger.setLevel(logging.DEBUG)
-        self.el_pipeline.process(text)
-        self.rl_pipeline.process(text)
+        entities_future = self.el_pipeline.process(text)
+        triples_future = self.rl_pipeline.process(text, self._rl_options(decoding))
+
+        entities = entities_future.result()
+        triples = triples_future.result()
+
+        # The graph is built in the build executor like for async callers, so the scorers are never used by two
+        # threads at once, e.g. by the warm-up and a request.
+        return self.build_executor.submit(self._build, text, entities, triples).result()
 
-        entities = self.el_pipeline.get()
-        triples = self.rl_pipeline.get()
+    async def construct_async(self, text: str, decoding: Optional[str] = None) -> KnowledgeGraph:
+        entities, triples = await asyncio.gather(
+            self.el_pipeline.process_async(text),
+            self.rl_pipeline.process_async(text, self._rl_options(decoding)))
 
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.build_executor, self._build, text, entities, triples)
+
+    async def construct_many_async(self, texts: List[str], return_exceptions: bool = False,
+                                   decodings: Optional[List[Optional[str]]] = None) \
+            -> AsyncIterator[Tuple[int, KnowledgeGraph | BaseException]]:
+        if decodings is None:
+            decodings = [None] * len(texts)
+
+        # All texts are submitted before any result is awaited, so the pipeline workers can batch them.
+        el_futures = [self.el_pipeline.process(text) for text in texts]
+        rl_futures = [self.rl_pipeline.process(text, self._rl_options(decoding))
+                      for text, decoding in zip(texts, decodings)]
+        loop = asyncio.get_running_loop()
+
+        async def construct(i: int) -> Tuple[int, KnowledgeGraph | BaseException]:
+            try:
+                entities, triples = await asyncio.gather(
+                    asyncio.wrap_future(el_futures[i]),
+                    asyncio.wrap_future(rl_futures[i]))
+                kg = await loop.run_in_executor(self.build_executor, self._build, texts[i], entities, triples)
+                return i, kg
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return i, e
+
+        # Graphs are yielded in the order in which they are completed, together with the index of their text.
+        tasks = [asyncio.ensure_future(construct(i)) for i in range(len(texts))]
+        try:
+            for result in asyncio.as_completed(tasks):
+                yield await result
+        finally:
+            # After a failure or when the consumer stops early, the remaining constructions are not needed anymore.
+            # Failures of constructions that completed but were not yielded are retrieved, so they are not reported.
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+
+    def construct_incremental(self, session_id: str, text: str, decoding: Optional[str] = None) -> KnowledgeGraph:
+        session, diff, futures = self._submit_changes(session_id, text, decoding)
+        results = [(start, el_future.result(), rl_future.result()) for start, el_future, rl_future in futures]
+
+        return self.build_executor.submit(self._build_incremental, session_id, text, session, diff, results).result()
+
+    async def construct_incremental_async(self, session_id: str, text: str, decoding: Optional[str] = None) \
+            -> KnowledgeGraph:
+        session, diff, futures = self._submit_changes(session_id, text, decoding)
+        results = []
+        for start, el_future, rl_future in futures:
+            entities, triples = await asyncio.gather(asyncio.wrap_future(el_future), asyncio.wrap_future(rl_future))
+            results.append((start, entities, triples))
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.build_executor, self._build_incremental,
+                                          session_id, text, session, diff, results)
+
+    def end_session(self, session_id: str) -> None:
+        with self.sessions_lock:
+            self.sessions.pop(session_id, None)
+
+    def _submit_changes(self, session_id: str, text: str, decoding: Optional[str]) \
+            -> Tuple[incremental.Session, incremental.TextDiff, list]:
+        with self.sessions_lock:
+            session = self.sessions.get(session_id)
+
+        if session is None:
+            session = incremental.Session(text="")
+
+        # Only the regions of changed sentences run through the pipelines, the first text of a session is one region.
+        diff = incremental.diff_texts(session.text, text, self.sentence_splitter)
+        self.logger.debug(f"Session {session_id}: {len(diff.unchanged)} unchanged sentences, "
+                          f"{len(diff.changed)} changed regions")
+
+        futures = []
+        for start, end in diff.changed:
+            futures.append((start,
+                            self.el_pipeline.process(text[start:end]),
+                            self.rl_pipeline.process(text[start:end], self._rl_options(decoding))))
+
+        return session, diff, futures
+
+    def _build_incremental(self, session_id: str, text: str, session: incremental.Session,
+                           diff: incremental.TextDiff, results: list) -> KnowledgeGraph:
+        entities, triples = incremental.carry_over(session, diff, text)
+        entities, triples = incremental.merge(entities, triples, results)
+
+        with self.sessions_lock:
+            self.sessions[session_id] = incremental.Session(text=text, entities=entities, triples=triples)
+
+        # The graph is built from copies, building must not change the candidates kept for the next revision.
+        return self._build(text, copy.deepcopy(entities), copy.deepcopy(triples))
+
+    @staticmethod
+    def _rl_options(decoding: Optional[str]) -> Optional[Dict[str, str]]:
+        # Without options the deployment's decoding profile is used.
+        return None if decoding is None else {"decoding": decoding}
+
+    def _build(self, text: str, entities: List[UniqueEntity], triples: List[Triple]) -> KnowledgeGraph:
+        self.scorer_loading.result()
         self.logger.debug(f"Found entities: {entities}")
         self.logger.debug(f"Found triples: {triples}")
 
+        start = time.time()
         kg_factory = KGFactory(text, triples, entities, self.triple_scorer)
         kg = kg_factory.build()
+        metrics.registry.observe("waka_kg_build_seconds", time.time() - start)
         self.logger.debug(f"Constructed graph: {kg.to_json()}")
 
         return kg
 
+    def metrics(self) -> str:
+        self.el_pipeline.update_metrics()
+        self.rl_pipeline.update_metrics()
+        return metrics.registry.to_prometheus()
+
+    def queue_depths(self) -> Dict[str, Dict[str, int]]:
+        return {
+            self.el_pipeline.name: self.el_pipeline.queue_depths(),
+            self.rl_pipeline.name: self.rl_pipeline.queue_depths()
+        }
+
     def __del__(self):
+        self.build_executor.shutdown(wait=False)
         self.el_pipeline.end()
         self.rl_pipeline.end()
         self.el_pipeline.join()
         self.rl_pipeline.join()
+        for server in self.model_servers:
+            server.stop()
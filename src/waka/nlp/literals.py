@@ -0,0 +1,95 @@
+import datetime
+import functools
+import re
+from typing import Optional, List, Iterable, Set
+
+import dateutil.parser
+import number_parser
+
+from waka.nlp.kg import EntityMention
+
+
+class RDFType:
+    DECIMAL = "http://www.w3.org/2001/XMLSchema#decimal"
+    DATETIME = "http://www.w3.org/2001/XMLSchema#dateTime"
+
+
+DECIMAL_TYPES = frozenset({"PERCENT", "MONEY", "QUANTITY", "CARDINAL", "ORDINAL"})
+DATE_TYPES = frozenset({"DATE", "TIME"})
+
+_NON_DECIMAL_CHARS = re.compile(r"[^0-9.\-–]")
+_INTEGER = re.compile(r"[+-]?[0-9]+")
+_YEAR = re.compile(r"[1-9][0-9]{3}")
+_ISO_DATE = re.compile(r"([1-9][0-9]{3})-([0-9]{2})-([0-9]{2})")
+
+# The same surface forms ("1843", "first", "two years") are found by several recognizers and in many texts.
+CACHE_SIZE = 2 ** 16
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def normalize_decimal(text: str) -> Optional[str]:
+    if _INTEGER.fullmatch(text):
+        return _decimal_url(float(text))
+
+    decimal = None
+    try:
+        decimal = float(_NON_DECIMAL_CHARS.sub("", text))
+    except ValueError:
+        pass
+
+    if decimal is None:
+        decimal = number_parser.parse_number(text)
+
+    if decimal is None:
+        decimal = number_parser.parse_ordinal(text)
+
+    if decimal is None:
+        return None
+
+    return _decimal_url(decimal)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def normalize_datetime(text: str) -> Optional[str]:
+    if _YEAR.fullmatch(text):
+        return f"{text}-01-01T00:00:00Z^^{RDFType.DATETIME}"
+
+    match = _ISO_DATE.fullmatch(text)
+    if match:
+        try:
+            date = datetime.date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+            return f"{date.isoformat()}T00:00:00Z^^{RDFType.DATETIME}"
+        except ValueError:
+            pass
+
+    try:
+        date = dateutil.parser.parse(text, default=datetime.datetime(1, 1, 1))
+        return f"{date.strftime('%Y-%m-%dT%H:%M:%SZ')}^^{RDFType.DATETIME}"
+    except ValueError:
+        return None
+
+
+def normalize_mentions(mentions: Iterable[EntityMention],
+                       decimal_types: Set[str] = DECIMAL_TYPES,
+                       date_types: Set[str] = DATE_TYPES) -> List[EntityMention]:
+    # Sets the literal URL of all decimal and date mentions without one and returns those that can't be parsed.
+    failed = []
+    for mention in mentions:
+        if mention.url is not None or mention.text is None:
+            continue
+
+        if mention.e_type in decimal_types:
+            mention.url = normalize_decimal(mention.text)
+        elif mention.e_type in date_types:
+            mention.url = normalize_datetime(mention.text)
+        else:
+            continue
+
+        if mention.url is None:
+            failed.append(mention)
+
+    return failed
+
+
+def _decimal_url(decimal: float) -> str:
+    return f"{decimal:+0.0f}^^{RDFType.DECIMAL}"
@@ -0,0 +1,127 @@
+import bisect
+import math
+import threading
+from typing import Dict, Tuple, List, Optional
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+
+    def describe(self, name: str, description: str) -> None:
+        self.help[name] = description
+
+    def inc(self, name: str, amount: float = 1.0, **labels: str) -> None:
+        key = _labels(labels)
+        with self.lock:
+            counter = self.counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0.0) + amount
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        with self.lock:
+            self.gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        with self.lock:
+            histograms = self.histograms.setdefault(name, {})
+            if key not in histograms:
+                histograms[key] = Histogram()
+            histograms[key].observe(value)
+
+    def record(self, events: List[tuple]) -> None:
+        # Events are plain tuples, so worker processes can send them through a queue.
+        for kind, name, value, labels in events:
+            if kind == "inc":
+                self.inc(name, value, **labels)
+            elif kind == "set":
+                self.set(name, value, **labels)
+            elif kind == "observe":
+                self.observe(name, value, **labels)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                self._header(lines, name, "counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{_format(labels)} {value}")
+
+            for name, series in sorted(self.gauges.items()):
+                self._header(lines, name, "gauge")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{_format(labels)} {value}")
+
+            for name, series in sorted(self.histograms.items()):
+                self._header(lines, name, "histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bucket, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if math.isinf(bucket) else repr(bucket)
+                        lines.append(f"{name}_bucket{_format(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines: List[str], name: str, metric_type: str) -> None:
+        if name in self.help:
+            lines.append(f"# HELP {name} {self.help[name]}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ""
+
+    escaped = [(key, value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for key, value in labels]
+    return "{" + ",".join(f"{key}=\"{value}\"" for key, value in escaped) + "}"
+
+
+def size_of(data: Optional[object]) -> int:
+    try:
+        return len(data)
+    except TypeError:
+        return 0
+
+
+registry = MetricsRegistry()
+registry.describe("waka_stage_queue_wait_seconds", "Time a text waited in the input queue of a pipeline stage.")
+registry.describe("waka_stage_queue_depth", "Number of texts waiting in the input queue of a pipeline stage.")
+registry.describe("waka_processor_seconds", "Processing time of a text processor per batch.")
+registry.describe("waka_processor_batches_total", "Number of batches processed by a text processor.")
+registry.describe("waka_processor_texts_total", "Number of texts processed by a text processor.")
+registry.describe("waka_processor_input_items_total", "Size of the input data passed to a text processor.")
+registry.describe("waka_processor_output_items_total", "Size of the output data returned by a text processor.")
+registry.describe("waka_processor_errors_total", "Number of failed calls of a text processor.")
+registry.describe("waka_pipeline_request_seconds", "Time from submitting a text to a pipeline until its result.")
+registry.describe("waka_pipeline_requests_total", "Number of texts processed by a pipeline, by outcome.")
+registry.describe("waka_scorer_seconds", "Time a triple scorer needs to score the triples of a text.")
+registry.describe("waka_cache_requests_total", "Number of cache lookups, by cache and result.")
+registry.describe("waka_kg_build_seconds", "Time needed to fuse entities and triples into a knowledge graph.")
@@ -0,0 +1,192 @@
+import functools
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+from multiprocessing import Process, Event, Pipe
+from multiprocessing.connection import Listener, Client, Connection, wait
+from typing import Callable, Any, List, Optional, Tuple
+
+
+class ModelServerError(Exception):
+    # Only the formatted traceback crosses the process boundary, arbitrary exceptions may not be picklable.
+    def __init__(self, message: str, remote_traceback: Optional[str] = None):
+        super().__init__(message)
+        self.remote_traceback = remote_traceback
+
+    def __reduce__(self):
+        return ModelServerError, (self.args[0], self.remote_traceback)
+
+
+class ModelServer(Process):
+    # Hosts the only loaded copy of one model for all processes. A served method takes a list of items plus
+    # optional arguments and returns one result per item, so the items of concurrent requests with the same method
+    # and arguments are concatenated into one batch.
+
+    def __init__(self, model: Callable[[], Any], max_batch_size: int = 64, max_latency_ms: float = 5.0,
+                 name: Optional[str] = None):
+        super().__init__(name=name, daemon=True)
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.directory = tempfile.mkdtemp(prefix="waka-model-server-")
+        self.address = os.path.join(self.directory, "socket")
+        self.authkey = os.urandom(32)
+        self.ready = Event()
+
+    def client(self) -> "ModelClient":
+        return ModelClient(self.address, self.authkey, self.ready, repr(self.model))
+
+    def run(self) -> None:
+        logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+        logger = logging.getLogger(f"{self.__class__.__name__}[{self.name}]")
+        logger.info("Load...")
+        model = self.model()
+
+        listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        connections: List[Connection] = []
+        lock = threading.Lock()
+        wakeup_reader, wakeup_writer = Pipe(duplex=False)
+        threading.Thread(target=self._accept, args=(listener, connections, lock, wakeup_writer),
+                         name=f"{self.name}-accept", daemon=True).start()
+        self.ready.set()
+
+        pending = []
+        while True:
+            # The first pending request bounds the wait, no request waits longer than the latency window for others.
+            timeout = None
+            if len(pending) > 0:
+                timeout = max(0.0, pending[0][-1] + self.max_latency - time.monotonic())
+
+            with lock:
+                waitables = [wakeup_reader, *connections]
+
+            for connection in wait(waitables, timeout):
+                if connection is wakeup_reader:
+                    wakeup_reader.recv()
+                    continue
+
+                try:
+                    request_id, method, args, items = connection.recv()
+                except (EOFError, OSError):
+                    with lock:
+                        connections.remove(connection)
+                    connection.close()
+                    continue
+
+                pending.append((connection, request_id, method, args, items, time.monotonic()))
+
+            num_items = sum(len(request[4]) for request in pending)
+            if len(pending) > 0 and (num_items >= self.max_batch_size
+                                     or time.monotonic() - pending[0][-1] >= self.max_latency):
+                self._serve(model, pending, logger)
+                pending = []
+
+    def _accept(self, listener: Listener, connections: List[Connection], lock: threading.Lock,
+                wakeup: Connection) -> None:
+        while True:
+            try:
+                connection = listener.accept()
+            except Exception:
+                continue
+
+            with lock:
+                connections.append(connection)
+            # The serving loop only waits on the connections it knew of before, so it is woken up to add this one.
+            wakeup.send(None)
+
+    @staticmethod
+    def _serve(model: Any, requests: List[tuple], logger: logging.Logger) -> None:
+        groups = {}
+        for request in requests:
+            groups.setdefault((request[2], request[3]), []).append(request)
+
+        for (method, args), group in groups.items():
+            items = [item for request in group for item in request[4]]
+            start = time.time()
+            try:
+                results = getattr(model, method)(items, *args)
+                if len(results) != len(items):
+                    raise ValueError(f"{method} returned {len(results)} results for {len(items)} items")
+            except Exception as e:
+                logger.exception(f"{method} failed for a batch of {len(items)} items from {len(group)} requests")
+                error = ModelServerError(f"{type(e).__name__}: {e}", traceback.format_exc())
+                results = [error] * len(items)
+            logger.debug(f"{method}: {len(items)} items from {len(group)} requests [{time.time() - start:.4f}s]")
+
+            offset = 0
+            for connection, request_id, _, _, request_items, _ in group:
+                request_results = results[offset:offset + len(request_items)]
+                offset += len(request_items)
+
+                error = next((result for result in request_results if isinstance(result, ModelServerError)), None)
+                try:
+                    connection.send((request_id, error if error is not None else list(request_results)))
+                except OSError:
+                    # The client is gone, its connection is dropped by the serving loop.
+                    pass
+
+    def stop(self) -> None:
+        if self.is_alive():
+            self.terminate()
+            self.join()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ModelClient:
+    # Stands in for the served model in any process: calling a method sends the items to the server and blocks
+    # until their results are back. Clients connect on first use, so they can be passed to spawned processes.
+
+    def __init__(self, address: str, authkey: bytes, ready: Event, model: str = ""):
+        self.address = address
+        self.authkey = authkey
+        self.ready = ready
+        self.model = model
+        self.connection = None
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+    def call(self, method: str, items: List[Any], *args: Any) -> List[Any]:
+        if len(items) == 0:
+            return []
+
+        with self.lock:
+            if self.connection is None:
+                self.ready.wait()
+                self.connection = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+
+            request_id = self.next_id
+            self.next_id += 1
+            try:
+                self.connection.send((request_id, method, args, list(items)))
+                response_id, results = self.connection.recv()
+            except (EOFError, OSError) as e:
+                self.connection = None
+                raise ModelServerError(f"Model server at {self.address} is not reachable: {e}")
+
+        if isinstance(results, ModelServerError):
+            raise results
+
+        if response_id != request_id:
+            raise ModelServerError(f"Received results of request {response_id} instead of {request_id}")
+
+        return results
+
+    def __getattr__(self, method: str) -> Callable[..., List[Any]]:
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        return functools.partial(self.call, method)
+
+    def __repr__(self) -> str:
+        # Only the served model, not the address of its server, so cache keys stay the same across restarts.
+        return f"{self.__class__.__name__}({self.model})"
+
+    def __getstate__(self) -> Tuple[str, bytes, Event, str]:
+        return self.address, self.authkey, self.ready, self.model
+
+    def __setstate__(self, state: Tuple[str, bytes, Event, str]) -> None:
+        self.__init__(*state)
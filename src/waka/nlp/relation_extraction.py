@@ -1,11 +1,13 @@
+import bisect
 import re
 from abc import ABCMeta
 from enum import Enum
-from typing import List, Optional
+from typing import List, Optional, Iterable, Tuple
 
 from nltk.tokenize import sent_tokenize
 from transformers import pipeline, AutoTokenizer, AutoModelForSeq2SeqLM
 
+from waka.nlp import devices
 from waka.nlp.kg import Triple, Property, EntityMention
 from waka.nlp.text_processor import TextProcessor
 
@@ -14,6 +16,40 @@ class RelationExtractor(TextProcessor[str, Triple], metaclass=ABCMeta):
     pass
 
 
+class SpanAligner:
+    def __init__(self, text: str, arguments: Iterable[str]):
+        self.text = text
+        patterns = sorted({argument for argument in arguments if argument}, key=len, reverse=True)
+        self.occurrences = {pattern: [] for pattern in patterns}
+
+        if len(patterns) > 0:
+            # All arguments are found in one pass over the text. The match is a zero-width lookahead, so arguments
+            # nested in others are found as well, and alternatives are tried longest first.
+            matcher = re.compile(f"(?<!\\w)(?=({'|'.join(map(re.escape, patterns))})(?!\\w))")
+            for match in matcher.finditer(text):
+                self.occurrences[match.group(1)].append(match.start())
+
+    def align(self, argument: str, start: int = 0, end: Optional[int] = None) -> Optional[int]:
+        # The first occurrence within the given span is preferred, usually the sentence the argument was found in.
+        end = len(self.text) if end is None else end
+        occurrences = self.occurrences.get(argument, [])
+
+        i = bisect.bisect_left(occurrences, start)
+        if i < len(occurrences) and occurrences[i] + len(argument) <= end:
+            return occurrences[i]
+
+        # Arguments starting at the same position as a longer one or without word boundaries are searched directly.
+        found = self.text.find(argument, start, end)
+        if found != -1:
+            return found
+
+        if len(occurrences) > 0:
+            return occurrences[0]
+
+        found = self.text.find(argument)
+        return None if found == -1 else found
+
+
 class TokenType(Enum):
     TRIPLE = 0
     SUBJECT = 1
@@ -93,7 +129,7 @@ class RebelExtractor(RelationExtractor):
     @staticmethod
     def get_resource(token: str, original_text: str, substr_indices: dict):
         if token not in substr_indices:
-            substr_indices[token] = [m.start() for m in re.finditer(f"\\b{token}\\b", original_text)]
+            substr_indices[token] = [m.start() for m in re.finditer(f"\\b{re.escape(token)}\\b", original_text)]
         start_idx = substr_indices[token][0]
         substr_indices[token].pop(0)
 
@@ -103,51 +139,156 @@ class RebelExtractor(RelationExtractor):
         return EntityMention(url=None, text="", start_idx=start_idx, end_idx=start_idx, e_type=None)
 
 
-class MRebelExtractor(RelationExtractor):
-    def __init__(self):
-        super().__init__()
+class MRebelModel:
+    CHECKPOINT = "models/mrebel-large"
+    # "beam" returns all beams and finds the most triples, the other profiles trade recall for latency. Profiles with
+    # a max_new_tokens_factor limit the generated tokens relative to the longest input of a batch.
+    DECODING_PROFILES = {
+        "beam": {"max_length": 512, "length_penalty": 0, "num_beams": 3, "num_return_sequences": 3},
+        "beam_early_stop": {"max_length": 512, "length_penalty": 0, "num_beams": 3, "num_return_sequences": 3,
+                            "early_stopping": True},
+        "small_beam": {"max_length": 512, "length_penalty": 0, "num_beams": 2, "num_return_sequences": 1},
+        "greedy": {"max_length": 512, "num_beams": 1, "num_return_sequences": 1},
+        "dynamic": {"num_beams": 1, "num_return_sequences": 1, "max_new_tokens_factor": 2.0},
+    }
+
+    def __init__(self, device: Optional[str] = None, quantize: Optional[bool] = None, max_batch_tokens: int = 4096,
+                 max_batch_sentences: int = 64):
         self.tokenizer = AutoTokenizer.from_pretrained(
-            "models/mrebel-large",
+            self.CHECKPOINT,
             local_files_only=True,
             src_lang="en_XX",
             tgt_lang="tp_XX")
 
-        self.model = AutoModelForSeq2SeqLM.from_pretrained("models/mrebel-large", local_files_only=True,)
-        self.model.to("cuda")
+        self.model = AutoModelForSeq2SeqLM.from_pretrained(self.CHECKPOINT, local_files_only=True,)
+        self.model = devices.prepare_model(self.model, devices.select_device(device), quantize)
 
-        self.gen_kwargs = {
-            "max_length": 512,
-            "length_penalty": 0,
-            "num_beams": 3,
-            "num_return_sequences": 3,
-            "forced_bos_token_id": None,
-        }
+        # A generate call gets at most max_batch_sentences sentences with max_batch_tokens input tokens including
+        # padding, which bounds the memory of beam search.
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_sentences = max_batch_sentences
 
-    def process(self, text: str, in_data: str) -> Optional[List[EntityMention | Triple]]:
-        super().process(text, in_data)
-        triples = []
-        triple_hashes = set()
+    def generate(self, sentences: List[str], decoding: str = "beam") -> List[List[str]]:
+        input_ids = self.tokenizer(sentences, max_length=512, truncation=True)["input_ids"] if sentences else []
+        gen_kwargs = {**self.DECODING_PROFILES[decoding], "forced_bos_token_id": None}
+        max_new_tokens_factor = gen_kwargs.pop("max_new_tokens_factor", None)
+        num_return_sequences = gen_kwargs["num_return_sequences"]
+        decoded_preds = [[] for _ in sentences]
 
-        sentences = [s for s in sent_tokenize(text)]
+        for bucket in self._buckets(input_ids):
+            if max_new_tokens_factor is not None:
+                longest = max(len(input_ids[i]) for i in bucket)
+                gen_kwargs["max_new_tokens"] = min(512, int(max_new_tokens_factor * longest) + 16)
 
-        model_inputs = self.tokenizer(sentences, max_length=512, padding=True, truncation=True, return_tensors='pt')
-        generated_tokens = self.model.generate(
-            model_inputs["input_ids"].to(self.model.device),
-            attention_mask=model_inputs["attention_mask"].to(self.model.device),
-            decoder_start_token_id=self.tokenizer.convert_tokens_to_ids("tp_XX"),
-            **self.gen_kwargs,
-        )
+            model_inputs = self.tokenizer.pad({"input_ids": [input_ids[i] for i in bucket]}, return_tensors="pt")
+            generated_tokens = self.model.generate(
+                model_inputs["input_ids"].to(self.model.device),
+                attention_mask=model_inputs["attention_mask"].to(self.model.device),
+                decoder_start_token_id=self.tokenizer.convert_tokens_to_ids("tp_XX"),
+                **gen_kwargs,
+            )
 
-        decoded_preds = self.tokenizer.batch_decode(generated_tokens, skip_special_tokens=False)
+            decoded = self.tokenizer.batch_decode(generated_tokens, skip_special_tokens=False)
+            for j, i in enumerate(bucket):
+                decoded_preds[i] = decoded[j * num_return_sequences:(j + 1) * num_return_sequences]
 
-        for token_string in decoded_preds:
-            for triple in self.extract_triplets(token_string, text):
-                triple_hash = hash(f"{triple.subject.text}:{triple.predicate.text}:{triple.object.text}")
-                if triple_hash not in triple_hashes:
-                    triple_hashes.add(triple_hash)
-                    triples.append(triple)
+        return decoded_preds
 
-        return triples
+    def _buckets(self, input_ids: List[List[int]]) -> List[List[int]]:
+        # Sentences are sorted by length, so a batch only contains sentences of similar length and little padding.
+        # Since the order is ascending, the last sentence of a batch determines its padded length.
+        buckets = []
+        bucket = []
+        for i in sorted(range(len(input_ids)), key=lambda i: len(input_ids[i])):
+            padded_tokens = (len(bucket) + 1) * len(input_ids[i])
+            if len(bucket) > 0 and (padded_tokens > self.max_batch_tokens or len(bucket) >= self.max_batch_sentences):
+                buckets.append(bucket)
+                bucket = []
+
+            bucket.append(i)
+
+        if len(bucket) > 0:
+            buckets.append(bucket)
+
+        return buckets
+
+
+class MRebelExtractor(RelationExtractor):
+    DECODING_PROFILES = MRebelModel.DECODING_PROFILES
+
+    def __init__(self, device: Optional[str] = None, quantize: Optional[bool] = None, max_batch_tokens: int = 4096,
+                 max_batch_sentences: int = 64, decoding: str = "beam", model: Optional[MRebelModel] = None):
+        super().__init__()
+        # The model is either loaded here or served by a model server, see ModelClient.
+        self.generator = model if model is not None else MRebelModel(device, quantize, max_batch_tokens,
+                                                                      max_batch_sentences)
+
+        if decoding not in self.DECODING_PROFILES:
+            raise ValueError(f"Unknown decoding profile \"{decoding}\", "
+                             f"expected one of {', '.join(self.DECODING_PROFILES)}")
+        self.decoding = decoding
+
+    def process(self, text: str, in_data: str) -> Optional[List[EntityMention | Triple]]:
+        super().process(text, in_data)
+        return self.process_batch([text], [in_data])[0]
+
+    def process_batch(self, texts: List[str], in_data: List[str]) -> List[Optional[List[EntityMention | Triple]]]:
+        # The sentences of all texts are generated together, so short documents share batches.
+        sentences = []
+        sentence_texts = []
+        sentence_spans = []
+        for i, text in enumerate(texts):
+            offset = 0
+            for sentence in sent_tokenize(text):
+                start = text.find(sentence, offset)
+                if start == -1:
+                    start = offset
+                offset = start + len(sentence)
+
+                sentences.append(sentence)
+                sentence_texts.append(i)
+                sentence_spans.append((start, offset))
+
+        results = [[] for _ in texts]
+        result_spans = [[] for _ in texts]
+        triple_hashes = [set() for _ in texts]
+
+        # The decoding profile of a request overrides the one of the deployment.
+        decoding = self.options.get("decoding") or self.decoding
+        if decoding not in self.DECODING_PROFILES:
+            raise ValueError(f"Unknown decoding profile \"{decoding}\"")
+
+        decoded = self.generator.generate(sentences, decoding)
+        for i, sentence_span, decoded_preds in zip(sentence_texts, sentence_spans, decoded):
+            for token_string in decoded_preds:
+                for triple in self.extract_triplets(token_string, texts[i]):
+                    triple_hash = hash(f"{triple.subject.text}:{triple.predicate.text}:{triple.object.text}")
+                    if triple_hash not in triple_hashes[i]:
+                        triple_hashes[i].add(triple_hash)
+                        results[i].append(triple)
+                        result_spans[i].append(sentence_span)
+
+        for text, triples, spans in zip(texts, results, result_spans):
+            self.align(text, triples, spans)
+
+        return results
+
+    def model_version(self) -> tuple:
+        # The generated triples depend on the parameters of the decoding profile, not only on its name.
+        decoding = self.options.get("decoding") or self.decoding
+        return MRebelModel.CHECKPOINT, decoding, tuple(sorted(self.DECODING_PROFILES.get(decoding, {}).items()))
+
+    @staticmethod
+    def align(text: str, triples: List[Triple], sentence_spans: List[Tuple[int, int]]) -> None:
+        arguments = [argument for triple in triples for argument in (triple.subject, triple.object)]
+        aligner = SpanAligner(text, (argument.text for argument in arguments))
+
+        for triple, (start, end) in zip(triples, sentence_spans):
+            for argument in (triple.subject, triple.object):
+                argument_start = aligner.align(argument.text, start, end)
+                if argument_start is not None:
+                    argument.start_idx = argument_start
+                    argument.end_idx = argument_start + len(argument.text)
 
     @staticmethod
     def extract_triplets(tagged_text: str, original_text: str) -> List[Triple]:
@@ -1,11 +1,8 @@
 import abc
-import copy
-import os
-import sys
-from typing import List
-
-from elasticsearch import Elasticsearch, AuthenticationException
+from typing import List, Optional
 
+from waka.nlp.cache import TieredCache
+from waka.nlp.entity_linking import ElasticRetriever, CachedRetriever, connect_elasticsearch
 from waka.nlp.kg import Triple
 from waka.nlp.text_processor import TextProcessor
 
@@ -15,22 +12,11 @@ class RelationLinker(TextProcessor[List[Triple], List[Triple]], metaclass=abc.AB
 
 
 class ElasticRelationLinker(RelationLinker):
-    def __init__(self, alpha=2, beta=0.72, min_score=8.0, max_results=33):
+    def __init__(self, alpha=2, beta=0.72, min_score=8.0, max_results=33, cache_size: Optional[int] = None,
+                 cache_ttl: Optional[float] = None, cache_path: Optional[str] = None):
         super().__init__()
         self.index_name = "corpus_wikidata_properties_20240717"
 
-        api_key = os.getenv("ES_API_KEY")
-        if api_key is None or api_key == "":
-            self.logger.error("Elasticsearch API key (ES_API_KEY) not set!")
-            sys.exit(1)
-
-        try:
-            self.es_client = Elasticsearch("https://elasticsearch.srv.webis.de", api_key=api_key,
-                                           retry_on_timeout=True, max_retries=10)
-        except AuthenticationException:
-            self.logger.error("Authentication to Elasticsearch failed!")
-            sys.exit(1)
-
         self.search_template = {
             "query": {
                 "function_score": {
@@ -55,28 +41,25 @@ class ElasticRelationLinker(RelationLinker):
             "min_score": min_score
         }
 
-    def process(self, text: str, triples: List[Triple]) -> List[Triple]:
-        searches = []
-        for triple in triples:
-            searches.append({"index": self.index_name})
-            query = copy.deepcopy(self.search_template)
-            query["query"]["function_score"]["query"]["query_string"]["query"] = (
-                triple.predicate.text
-            )
-            searches.append(query)
+        self.retriever = ElasticRetriever(connect_elasticsearch(self.logger), self.index_name, self.search_template)
+        if cache_size is not None:
+            # Predicates like "located in" recur across documents, their candidates are only retrieved once.
+            self.retriever = CachedRetriever(self.retriever, TieredCache("relation_candidates", maxsize=cache_size,
+                                                                         ttl=cache_ttl, path=cache_path))
 
-        results = self.es_client.msearch(searches=searches)
-        for response, triple in zip(results["responses"], triples):
-            if response["status"] != 200:
+    def process(self, text: str, triples: List[Triple]) -> List[Triple]:
+        results = self.retriever.search([triple.predicate.text for triple in triples])
+        for hits, triple in zip(results, triples):
+            if hits is None:
                 continue
 
-            if len(response["hits"]["hits"]) > 0:
-                hit = response["hits"]["hits"][0]
+            if len(hits) > 0:
+                hit = hits[0]
                 triple.predicate.url = hit["_id"]
                 triple.predicate.label = hit["_source"]["label"]
                 triple.predicate.description = hit["_source"]["description"]
 
         return triples
 
-
-
+    def collect_metrics(self) -> List[tuple]:
+        return self.retriever.collect_metrics()
@@ -1,5 +1,5 @@
 import abc
-from typing import List
+from typing import List, Optional, Tuple
 
 import numpy as np
 import requests
@@ -8,8 +8,9 @@ from nltk.tokenize import PunktSentenceTokenizer
 from numpy import ndarray, dtype
 from sentence_transformers.SentenceTransformer import SentenceTransformer
 from sentence_transformers.util import cos_sim
-from transformers import pipeline, AutoTokenizer, AutoModelForSequenceClassification
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
 
+from waka.nlp import literals, devices
 from waka.nlp.kg import Triple, LinkedEntity, UniqueEntity
 from waka.nlp.text_processor import TextProcessor
 
@@ -20,13 +21,61 @@ class TripleScorer(metaclass=abc.ABCMeta):
         pass
 
 
+class SentenceEncoder:
+    def __init__(self, model_name: str, device: Optional[str] = None, quantize: Optional[bool] = None):
+        device = devices.select_device(device)
+        self.sentence_transformer = devices.prepare_model(
+            SentenceTransformer(model_name, device=device), device, quantize)
+
+    def encode(self, texts: List[str]) -> List[ndarray]:
+        return list(self.sentence_transformer.encode(texts, convert_to_numpy=True))
+
+
+class NLIModel:
+    def __init__(self, model_name: str = "models/bart-large-mnli", device: Optional[str] = None,
+                 quantize: Optional[bool] = None, batch_size: int = 8):
+        device = devices.select_device(device)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name, local_files_only=True)
+        self.model = devices.prepare_model(self.model, device, quantize)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, local_files_only=True)
+        self.batch_size = batch_size
+
+        label_ids = {label.lower(): i for label, i in self.model.config.label2id.items()}
+        self.contradiction_id = label_ids["contradiction"]
+        self.entailment_id = label_ids["entailment"]
+
+    def entailment(self, items: List[Tuple[str, List[str]]]) -> List[List[float]]:
+        # Like the zero-shot classification pipeline with multi_label, every hypothesis is scored on its own by
+        # the softmax over the contradiction and entailment logits.
+        pairs = [(premise, hypothesis) for premise, hypotheses in items for hypothesis in hypotheses]
+        scores = []
+        for i in range(0, len(pairs), self.batch_size):
+            batch = pairs[i:i + self.batch_size]
+            inputs = self.tokenizer([premise for premise, _ in batch], [hypothesis for _, hypothesis in batch],
+                                    truncation="only_first", padding=True, return_tensors="pt")
+            with torch.no_grad():
+                logits = self.model(**inputs.to(self.model.device)).logits
+
+            probabilities = logits[:, [self.contradiction_id, self.entailment_id]].softmax(dim=-1)
+            scores.extend(probabilities[:, 1].tolist())
+
+        results = []
+        offset = 0
+        for _, hypotheses in items:
+            results.append(scores[offset:offset + len(hypotheses)])
+            offset += len(hypotheses)
+
+        return results
+
+
 class SentenceBert(TripleScorer):
-    def __init__(self):
-        self.sentence_transformer = SentenceTransformer("paraphrase-mpnet-base-v2", device="cuda")
+    def __init__(self, device: Optional[str] = None, quantize: Optional[bool] = None,
+                 model: Optional[SentenceEncoder] = None):
+        # The model is either loaded here or served by a model server, see ModelClient.
+        self.encoder = model if model is not None else SentenceEncoder("paraphrase-mpnet-base-v2", device, quantize)
 
     def _score(self, *texts: str) -> ndarray[float, dtype[float]]:
-        embeddings = self.sentence_transformer.encode(*texts,
-                                                      convert_to_tensor=True)
+        embeddings = self.encoder.encode(list(texts))
 
         flat_sim_triples = np.zeros((len(texts) // 3, 3))
         for i in range(0, len(texts), 3):
@@ -92,7 +141,7 @@ class WikidataFilter(TripleScorer):
 
 
 class EntityScorer(TextProcessor[List[LinkedEntity], List[UniqueEntity]], metaclass=abc.ABCMeta):
-    LITERAL_TYPES = {"PERCENT", "MONEY", "QUANTITY", "CARDINAL", "ORDINAL", "DATE", "TIME"}
+    LITERAL_TYPES = literals.DECIMAL_TYPES | literals.DATE_TYPES
 
     @abc.abstractmethod
     def score(self, text: str, entities: List[LinkedEntity]) -> List[LinkedEntity]:
@@ -142,14 +191,13 @@ class EntityScorer(TextProcessor[List[LinkedEntity], List[UniqueEntity]], metacl
 
 
 class BartMNLI(TripleScorer):
-    def __init__(self):
+    HYPOTHESIS_TEMPLATE = "This example is {}."
+
+    def __init__(self, device: Optional[str] = None, quantize: Optional[bool] = None,
+                 model: Optional[NLIModel] = None):
         super().__init__()
-        self.nli_model = AutoModelForSequenceClassification.from_pretrained('models/bart-large-mnli', local_files_only=True)
-        self.tokenizer = AutoTokenizer.from_pretrained('models/bart-large-mnli', local_files_only=True)
-        # self.nli_model = AutoModelForSequenceClassification.from_pretrained('MoritzLaurer/DeBERTa-v3-base-mnli-fever-anli')
-        # self.tokenizer = AutoTokenizer.from_pretrained('MoritzLaurer/DeBERTa-v3-base-mnli-fever-anli')
-        self.classifier = pipeline("zero-shot-classification", model=self.nli_model, tokenizer=self.tokenizer,
-                                   device=torch.cuda.current_device())
+        self.nli_model = model if model is not None else NLIModel('models/bart-large-mnli', device, quantize)
+        # self.nli_model = NLIModel('MoritzLaurer/DeBERTa-v3-base-mnli-fever-anli', device, quantize)
 
     def score(self, text: str, triples: List[Triple]) -> List[Triple]:
         labels = {}
@@ -164,9 +212,10 @@ class BartMNLI(TripleScorer):
             labels[label].append(t)
 
         if len(labels) > 0:
-            result = self.classifier(text, list(labels.keys()),  multi_label=True)
+            hypotheses = [self.HYPOTHESIS_TEMPLATE.format(label) for label in labels]
+            scores = self.nli_model.entailment([(text, hypotheses)])[0]
 
-            for label, score in zip(result["labels"], result["scores"]):
+            for label, score in zip(labels, scores):
                 for triple in labels[label]:
                     triple.score *= score
 
@@ -175,9 +224,10 @@ class BartMNLI(TripleScorer):
 
 class EntitySentenceBert(EntityScorer):
 
-    def __init__(self):
+    def __init__(self, device: Optional[str] = None, quantize: Optional[bool] = None,
+                 model: Optional[SentenceEncoder] = None):
         super().__init__()
-        self.sentence_transformer = SentenceTransformer("models/all-distilroberta-v1", device="cuda")
+        self.encoder = model if model is not None else SentenceEncoder("models/all-distilroberta-v1", device, quantize)
 
     def score(self, text: str, entities: List[LinkedEntity]) -> List[LinkedEntity]:
         sentence_spans = PunktSentenceTokenizer().span_tokenize(text)
@@ -189,6 +239,7 @@ class EntitySentenceBert(EntityScorer):
         score_entities = list(sorted(score_entities, key=lambda e: e.start_idx))
         entity_iter = iter(score_entities)
         entity = None
+        groups = []
         for span in sentence_spans:
             sentence_entities = []
 
@@ -207,14 +258,21 @@ class EntitySentenceBert(EntityScorer):
 
                 sentence_entities.append(entity)
 
-            texts = [f"{c.label} is a {c.description}" for c in sentence_entities]
-            sentences = [text[span[0]:span[1]], *texts]
-            embeddings = self.sentence_transformer.encode(sentences,
-                                                          convert_to_tensor=True)
-
-            for i in range(1, len(embeddings)):
-                sim = cos_sim(embeddings[0], embeddings[i])[0][0].item()
-                sentence_entities[i - 1].score *= sim
+            groups.append((span, sentence_entities))
+
+        # The sentences and entity descriptions of the whole text are encoded in one batch.
+        sentences = []
+        for span, sentence_entities in groups:
+            sentences.append(text[span[0]:span[1]])
+            sentences.extend(f"{c.label} is a {c.description}" for c in sentence_entities)
+        embeddings = self.encoder.encode(sentences)
+
+        offset = 0
+        for _, sentence_entities in groups:
+            for i, candidate in enumerate(sentence_entities, start=1):
+                sim = cos_sim(embeddings[offset], embeddings[offset + i])[0][0].item()
+                candidate.score *= sim
+            offset += len(sentence_entities) + 1
 
         entities = list(sorted(entities, key=lambda e: e.score, reverse=True))
         # return entities
@@ -1,8 +1,21 @@
 import abc
+import asyncio
+import functools
 import logging
+import threading
 import time
-from multiprocessing import Process, Queue
-from typing import Optional, List, TypeVar, Generic
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor, InvalidStateError
+from multiprocessing import Process, Queue, Value, Event
+from multiprocessing.sharedctypes import Synchronized
+from queue import Empty
+from typing import Optional, List, TypeVar, Generic, Dict, Any, Iterable, Iterator, Tuple
+
+from waka.nlp import columnar, metrics
+
+# "pickle" sends result objects as they are, "columnar" packs them into arrays and "shared_memory" additionally
+# moves these arrays into a shared memory block, so only a handle is pickled.
+TRANSPORTS = ("pickle", "columnar", "shared_memory")
 
 IN = TypeVar("IN")
 OUT = TypeVar("OUT")
@@ -14,59 +27,437 @@ class TextProcessor(Generic[IN, OUT], metaclass=abc.ABCMeta):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.DEBUG)
         self.logger.info("Load...")
+        # Options of the request that is processed, set by the pipeline worker for every batch.
+        self.options = {}
 
     @abc.abstractmethod
     def process(self, text: str, in_data: IN) -> Optional[List[OUT]]:
         # self.logger.debug(f"Process \"{in_data}\"")
         return None
 
+    def process_batch(self, texts: List[str], in_data: List[IN]) -> List[Optional[List[OUT]]]:
+        # Processors backed by models with native batching should override this.
+        return [self.process(text, data) for text, data in zip(texts, in_data)]
 
-class Pipeline(Generic[OUT], Process):
-    processors: List[type[TextProcessor]]
+    def collect_metrics(self) -> List[tuple]:
+        # Metric events of the processor itself, e.g. of caches, in the format of MetricsRegistry.record. The
+        # pipeline worker collects them after every batch.
+        return []
+
+    def model_version(self) -> tuple:
+        # Everything besides the text and the options that determines the results, i.e. the loaded models. Cached
+        # results of other versions are not reused.
+        return self.__class__.__name__,
+
+
+class PipelineError(Exception):
+    # Only the formatted traceback crosses the process boundary, arbitrary exceptions may not be picklable.
+    def __init__(self, message: str, remote_traceback: Optional[str] = None):
+        super().__init__(message)
+        self.remote_traceback = remote_traceback
+
+    def __reduce__(self):
+        return PipelineError, (self.args[0], self.remote_traceback)
+
+
+class PipelineWorker(Process):
     instances: List[TextProcessor]
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, processors: List[type[TextProcessor]], in_queue: Queue, out_queue: Queue,
+                 upstream_count: int, eof_count: Synchronized, num_siblings: int,
+                 eof_token: str, stop_token: str, batch_size: int = 1, batch_timeout: float = 0.0,
+                 transport: str = "pickle", parallel_loading: bool = True, pipeline_name: str = "",
+                 stage_name: str = "", metrics_queue: Optional[Queue] = None, name: Optional[str] = None):
+        super().__init__(name=name)
+        self.processors = processors
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.upstream_count = upstream_count
+        self.eof_count = eof_count
+        self.num_siblings = num_siblings
+        self.eof_token = eof_token
+        self.stop_token = stop_token
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.transport = transport
+        self.parallel_loading = parallel_loading
+        self.pipeline_name = pipeline_name
+        self.stage_name = stage_name
+        self.metrics_queue = metrics_queue
+        self.metric_events = []
+        self.ready = Event()
+        self.instances = []
+
+    def run(self) -> None:
+        self.instances = self._load()
+        self.ready.set()
+
+        while True:
+            try:
+                batch, control = self._next_batch()
+            except KeyboardInterrupt:
+                self.out_queue.put(self.eof_token)
+                return
+
+            if len(batch) > 0:
+                self._handle(batch)
+                self._flush_metrics()
+
+            if control == self.eof_token:
+                # Every upstream worker sends one end token after its last result. Once all of them have been
+                # received the input is drained, so the remaining replicas of this stage are stopped as well.
+                with self.eof_count.get_lock():
+                    self.eof_count.value += 1
+                    drained = self.eof_count.value == self.upstream_count
+
+                if not drained:
+                    continue
+
+                for _ in range(self.num_siblings - 1):
+                    self.in_queue.put(self.stop_token)
+
+                self.out_queue.put(self.eof_token)
+                return
+
+            if control == self.stop_token:
+                self.out_queue.put(self.eof_token)
+                return
+
+    def _load(self) -> List[TextProcessor]:
+        if not self.parallel_loading or len(self.processors) < 2:
+            return [processor() for processor in self.processors]
+
+        # Model loading is mostly I/O and native initialisation, so the processors are loaded side by side.
+        with ThreadPoolExecutor(max_workers=len(self.processors), thread_name_prefix=f"{self.name}-load") as executor:
+            futures = [executor.submit(processor) for processor in self.processors]
+            return [future.result() for future in futures]
+
+    def _next_batch(self) -> Tuple[List[tuple], Optional[str]]:
+        batch = []
+        message = self.in_queue.get()
+        deadline = time.monotonic() + self.batch_timeout
+
+        while True:
+            if message == self.eof_token or message == self.stop_token:
+                return batch, message
+
+            request_id, text, in_data, options, enqueued_at = message
+            self._metric("observe", "waka_stage_queue_wait_seconds", max(0.0, time.time() - enqueued_at),
+                         pipeline=self.pipeline_name, stage=self.stage_name)
+
+            if isinstance(in_data, columnar.ColumnarBatch):
+                in_data = columnar.decode(in_data)
+
+            batch.append((request_id, text, in_data, options))
+            if len(batch) >= self.batch_size:
+                return batch, None
+
+            # Texts that are already queued are always taken, the timeout only bounds how long to wait for more.
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    message = self.in_queue.get(timeout=remaining)
+                else:
+                    message = self.in_queue.get_nowait()
+            except Empty:
+                return batch, None
+
+    def _handle(self, batch: List[tuple]) -> None:
+        # Texts are only batched with texts of the same request options.
+        groups = {}
+        for item in batch:
+            groups.setdefault(_options_key(item[3]), []).append(item)
+
+        for group in groups.values():
+            self._handle_group(group)
+
+    def _handle_group(self, batch: List[tuple]) -> None:
+        options = batch[0][3] or {}
+        for processor in self.instances:
+            processor.options = options
+
+        results = [in_data for _, _, in_data, _ in batch]
+        pending = [i for i, in_data in enumerate(results) if not isinstance(in_data, PipelineError)]
+
+        if len(pending) > 1:
+            try:
+                out_data = self._process([batch[i][1] for i in pending], [batch[i][2] for i in pending])
+                for i, out in zip(pending, out_data):
+                    results[i] = out
+                pending = []
+            except Exception:
+                self.instances[0].logger.exception(
+                    f"Processing of a batch of {len(pending)} texts failed, process them one by one")
+
+        # Single texts and failed batches are processed one by one, so a bad text only fails its own request.
+        for i in pending:
+            request_id, text, in_data, _ = batch[i]
+            try:
+                results[i] = self._process([text], [in_data])[0]
+            except Exception as e:
+                self.instances[0].logger.exception(f"Processing of request {request_id} failed")
+                results[i] = PipelineError(f"{type(e).__name__}: {e}", traceback.format_exc())
+
+        for (request_id, text, _, options), out_data in zip(batch, results):
+            self.out_queue.put((request_id, text, encode_transport(out_data, self.transport), options, time.time()))
+
+    def _process(self, texts: List[str], in_data: List[Any]) -> List[Any]:
+        out_data = None
+        for processor in self.instances:
+            labels = {"pipeline": self.pipeline_name, "processor": processor.__class__.__name__}
+            start = time.time()
+            try:
+                out_data = processor.process_batch(texts, in_data)
+                exec_time = time.time() - start
+
+                if len(out_data) != len(texts):
+                    raise ValueError(f"{processor.__class__.__name__} returned {len(out_data)} results "
+                                     f"for a batch of {len(texts)} texts")
+            except Exception:
+                self._metric("inc", "waka_processor_errors_total", 1, **labels)
+                raise
+
+            for kind, name, value, processor_labels in processor.collect_metrics():
+                self._metric(kind, name, value, **processor_labels)
+
+            in_size = sum(map(metrics.size_of, in_data))
+            out_size = sum(map(metrics.size_of, out_data))
+            self._metric("observe", "waka_processor_seconds", exec_time, **labels)
+            self._metric("inc", "waka_processor_batches_total", 1, **labels)
+            self._metric("inc", "waka_processor_texts_total", len(texts), **labels)
+            self._metric("inc", "waka_processor_input_items_total", in_size, **labels)
+            self._metric("inc", "waka_processor_output_items_total", out_size, **labels)
+
+            processor.logger.debug(f"In: {len(in_data)} x {type(in_data[0])}({in_size}) [{exec_time:.4f}s]")
+            in_data = out_data
+
+        return out_data
+
+    def _metric(self, kind: str, name: str, value: float, **labels: str) -> None:
+        if self.metrics_queue is not None:
+            self.metric_events.append((kind, name, value, labels))
+
+    def _flush_metrics(self) -> None:
+        # Metrics are sent once per batch to keep the number of queue messages low.
+        if self.metrics_queue is not None and len(self.metric_events) > 0:
+            self.metrics_queue.put(self.metric_events)
+            self.metric_events = []
+
+
+class Pipeline(Generic[OUT]):
+    processors: List[type[TextProcessor]]
+    workers: List[PipelineWorker]
+    stage_queues: List[Queue]
+
+    def __init__(self, num_workers: int = 1, stage_parallel: bool = False, queue_size: int = 8,
+                 batch_size: int = 1, batch_timeout_ms: float = 0.0, transport: str = "pickle",
+                 parallel_loading: bool = True, name: Optional[str] = None):
+        if num_workers < 1:
+            raise ValueError(f"A pipeline needs at least one worker, got {num_workers}")
+
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport \"{transport}\", expected one of {', '.join(TRANSPORTS)}")
+
+        if batch_size < 1:
+            raise ValueError(f"The batch size must be at least one, got {batch_size}")
+
+        self.name = name if name is not None else f"{self.__class__.__name__}-{id(self):x}"
+        self.num_workers = num_workers
+        self.stage_parallel = stage_parallel
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_timeout_ms = batch_timeout_ms
+        self.transport = transport
+        self.parallel_loading = parallel_loading
+        self.metrics_queue = Queue()
         self.in_queue = Queue()
         self.out_queue = Queue()
         self.processors = []
         self.eof_token = "<end>"
-        self.instances = []
+        self.stop_token = "<stop>"
+        self.workers = []
+        self.stage_names = []
+        self.stage_queues = []
+
+        self._futures: Dict[int, Tuple[Future, float]] = {}
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._dispatcher = None
+        self._metrics_collector = None
 
     def add_processor(self, processor: type[TextProcessor]):
         self.processors.append(processor)
 
-    def process(self, text: str) -> None:
-        self.in_queue.put(text)
+    def start(self) -> None:
+        if self.stage_parallel:
+            stages = [[processor] for processor in self.processors]
+        else:
+            stages = [self.processors]
 
-    def run(self) -> None:
-        for processor in self.processors:
-            self.instances.append(processor())
+        # Stages are connected by bounded queues, so a slow stage blocks its upstream stage instead of letting
+        # intermediate results pile up. The pipeline input stays unbounded to never block submitting callers.
+        self.stage_queues = [self.in_queue]
+        for _ in range(len(stages) - 1):
+            self.stage_queues.append(Queue(maxsize=self.queue_size))
+        self.stage_queues.append(self.out_queue)
 
-        while True:
+        upstream_count = 1
+        for i, stage in enumerate(stages):
+            stage_name = "+".join(_processor_name(processor) for processor in stage)
+            self.stage_names.append(stage_name)
+            eof_count = Value("i", 0)
+
+            # All replicas of a stage share its input queue, so an idle worker picks up the next item right away.
+            for j in range(self.num_workers):
+                worker = PipelineWorker(stage, self.stage_queues[i], self.stage_queues[i + 1],
+                                        upstream_count, eof_count, self.num_workers,
+                                        self.eof_token, self.stop_token,
+                                        batch_size=self.batch_size, batch_timeout=self.batch_timeout_ms / 1000,
+                                        transport=self.transport, parallel_loading=self.parallel_loading,
+                                        pipeline_name=self.name, stage_name=stage_name,
+                                        metrics_queue=self.metrics_queue, name=f"{self.name}-{stage_name}-{j}")
+                worker.start()
+                self.workers.append(worker)
+
+            upstream_count = self.num_workers
+
+        self._dispatcher = threading.Thread(target=self._dispatch, args=(upstream_count,),
+                                            name=f"{self.name}-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+        self._metrics_collector = threading.Thread(target=self._collect_metrics,
+                                                   name=f"{self.name}-metrics", daemon=True)
+        self._metrics_collector.start()
+
+    def is_ready(self) -> bool:
+        return len(self.workers) > 0 and all(worker.ready.is_set() and worker.is_alive() for worker in self.workers)
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in self.workers:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not worker.ready.wait(remaining):
+                return False
+
+        return self.is_ready()
+
+    def process(self, text: str, options: Optional[Dict[str, Any]] = None) -> Future:
+        future = Future()
+        with self._lock:
+            request_id = self._next_id
+            self._next_id += 1
+            self._futures[request_id] = future, time.time()
+
+        self.in_queue.put((request_id, text, text, options, time.time()))
+        return future
+
+    async def process_async(self, text: str, options: Optional[Dict[str, Any]] = None) -> OUT:
+        return await asyncio.wrap_future(self.process(text, options))
+
+    def map(self, texts: Iterable[str], options: Optional[Dict[str, Any]] = None) -> Iterator[OUT]:
+        # Results are yielded in submission order, independent of which worker finishes first.
+        futures = [self.process(text, options) for text in texts]
+        for future in futures:
+            yield future.result()
+
+    def update_metrics(self) -> None:
+        for stage_name, depth in self.queue_depths().items():
+            if depth >= 0:
+                metrics.registry.set("waka_stage_queue_depth", depth, pipeline=self.name, stage=stage_name)
+
+    def queue_depths(self) -> Dict[str, int]:
+        depths = {}
+        for stage_name, queue in zip(self.stage_names, self.stage_queues):
             try:
-                text = self.in_queue.get()
-            except KeyboardInterrupt:
-                self.end()
-                return
+                depths[stage_name] = queue.qsize()
+            except NotImplementedError:
+                # qsize() relies on sem_getvalue(), which is not available on macOS.
+                depths[stage_name] = -1
 
-            if text == self.eof_token:
-                return
+        return depths
 
-            in_data = text
-            out_data = None
-            for processor in self.instances:
-                start = time.time()
-                out_data = processor.process(text, in_data)
-                exec_time = time.time() - start
+    def _dispatch(self, upstream_count: int) -> None:
+        while upstream_count > 0:
+            message = self.out_queue.get()
+            if message == self.eof_token:
+                upstream_count -= 1
+                continue
+
+            request_id, _, out_data, _, _ = message
+
+            # Results are materialised into objects only here, at the boundary to the caller. This also releases
+            # the shared memory of results whose request is unknown.
+            if isinstance(out_data, columnar.ColumnarBatch):
+                try:
+                    out_data = columnar.decode(out_data)
+                except Exception as e:
+                    out_data = PipelineError(f"Decoding of request {request_id} failed: {type(e).__name__}: {e}",
+                                             traceback.format_exc())
 
-                processor.logger.debug(f"In: {type(in_data)}({len(in_data)}) [{exec_time:.4f}s]")
-                in_data = out_data
+            with self._lock:
+                future, submitted = self._futures.pop(request_id, (None, None))
 
-            self.out_queue.put(out_data)
+            if future is None:
+                continue
 
-    def get(self) -> Optional[OUT]:
-        return self.out_queue.get()
+            failed = isinstance(out_data, PipelineError)
+            metrics.registry.observe("waka_pipeline_request_seconds", time.time() - submitted, pipeline=self.name)
+            metrics.registry.inc("waka_pipeline_requests_total", 1, pipeline=self.name,
+                                 outcome="error" if failed else "ok")
+
+            # The futures of abandoned requests may have been cancelled in the meantime, their results are dropped.
+            try:
+                if failed:
+                    future.set_exception(out_data)
+                else:
+                    future.set_result(out_data)
+            except InvalidStateError:
+                pass
+
+        with self._lock:
+            futures = [future for future, _ in self._futures.values()]
+            self._futures.clear()
+
+        for future in futures:
+            if not future.done():
+                future.set_exception(PipelineError(f"{self.name} ended before the request was processed"))
+
+    def _collect_metrics(self) -> None:
+        while True:
+            events = self.metrics_queue.get()
+            if events == self.eof_token:
+                return
+
+            metrics.registry.record(events)
 
     def end(self):
         self.in_queue.put(self.eof_token)
+
+    def join(self, timeout: Optional[float] = None):
+        for worker in self.workers:
+            worker.join(timeout)
+
+        if all(not worker.is_alive() for worker in self.workers):
+            self.metrics_queue.put(self.eof_token)
+            # The collector has to be done reading before the interpreter may tear down the queue.
+            if self._metrics_collector is not None:
+                self._metrics_collector.join(timeout)
+
+
+def encode_transport(data: Any, transport: str) -> Any:
+    if transport == "pickle" or not columnar.can_encode(data):
+        return data
+
+    return columnar.encode(data, use_shared_memory=transport == "shared_memory")
+
+
+def _options_key(options: Optional[Dict[str, Any]]) -> str:
+    # Option values may be unhashable, e.g. lists, so requests are grouped by the representation of their options.
+    return repr(sorted(options.items())) if options else ""
+
+
+def _processor_name(processor: type[TextProcessor]) -> str:
+    if isinstance(processor, functools.partial):
+        return _processor_name(processor.func)
+
+    return getattr(processor, "__name__", processor.__class__.__name__)
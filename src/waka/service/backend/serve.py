@@ -1,19 +1,23 @@
 import json
 import multiprocessing
+import os
+from typing import List, AsyncIterator, Tuple, Optional, Literal
 
 import uvicorn
 from fastapi import FastAPI, APIRouter
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from starlette.responses import RedirectResponse
+from starlette.responses import RedirectResponse, JSONResponse, PlainTextResponse, StreamingResponse
 
 from waka.nlp.kg import KnowledgeGraph
 from waka.nlp.kg_construction import KGConstructor
+from waka.nlp.relation_extraction import MRebelExtractor
 
 
 class Text(BaseModel):
     content: str
+    decoding: Optional[Literal[tuple(MRebelExtractor.DECODING_PROFILES)]] = None
 
 
 def app():
@@ -46,22 +50,123 @@ def app():
 class KGConstructionRouter(APIRouter):
     def __init__(self):
         super().__init__()
-        self.kg_construct = KGConstructor()
+        self.kg_construct = KGConstructor(
+            el_workers=int(os.getenv("WAKA_EL_WORKERS", "1")),
+            rl_workers=int(os.getenv("WAKA_RL_WORKERS", "1")),
+            stage_parallel=os.getenv("WAKA_STAGE_PARALLEL", "0") == "1",
+            batch_size=int(os.getenv("WAKA_BATCH_SIZE", "1")),
+            batch_timeout_ms=float(os.getenv("WAKA_BATCH_TIMEOUT_MS", "0")),
+            transport=os.getenv("WAKA_TRANSPORT", "pickle"),
+            ner_concurrent=os.getenv("WAKA_NER_CONCURRENT", "0") == "1",
+            ner_timeout=float(os.environ["WAKA_NER_TIMEOUT"]) if "WAKA_NER_TIMEOUT" in os.environ else None,
+            ner_min_agreement=int(os.getenv("WAKA_NER_MIN_AGREEMENT", "1")),
+            ner_overlap=os.getenv("WAKA_NER_OVERLAP", "keep"),
+            ner_noun_phrases=os.getenv("WAKA_NER_NOUN_PHRASES", "constituency"),
+            ner_spacy_batch_size=int(os.getenv("WAKA_NER_SPACY_BATCH_SIZE", "32")),
+            ner_spacy_processes=int(os.getenv("WAKA_NER_SPACY_PROCESSES", "1")),
+            ner_flair_batch_size=int(os.getenv("WAKA_NER_FLAIR_BATCH_SIZE", "32")),
+            chunk_size=int(os.environ["WAKA_CHUNK_SIZE"]) if "WAKA_CHUNK_SIZE" in os.environ else None,
+            chunk_overlap=int(os.getenv("WAKA_CHUNK_OVERLAP", "1")),
+            decoding=os.getenv("WAKA_DECODING", "beam"),
+            cache_size=int(os.environ["WAKA_CACHE_SIZE"]) if "WAKA_CACHE_SIZE" in os.environ else None,
+            cache_path=os.getenv("WAKA_CACHE_PATH"),
+            cache_version=os.getenv("WAKA_CACHE_VERSION"),
+            candidate_cache_size=int(os.environ["WAKA_CANDIDATE_CACHE_SIZE"])
+            if "WAKA_CANDIDATE_CACHE_SIZE" in os.environ else None,
+            candidate_cache_ttl=float(os.environ["WAKA_CANDIDATE_CACHE_TTL"])
+            if "WAKA_CANDIDATE_CACHE_TTL" in os.environ else None,
+            candidate_cache_path=os.getenv("WAKA_CANDIDATE_CACHE_PATH"),
+            max_sessions=int(os.getenv("WAKA_MAX_SESSIONS", "1000")),
+            session_ttl=float(os.getenv("WAKA_SESSION_TTL", "3600")),
+            model_server=os.getenv("WAKA_MODEL_SERVER", "0") == "1",
+            model_batch_size=int(os.getenv("WAKA_MODEL_BATCH_SIZE", "64")),
+            model_max_latency_ms=float(os.getenv("WAKA_MODEL_MAX_LATENCY_MS", "5")),
+            warmup_text=KGConstructor.WARMUP_TEXT if os.getenv("WAKA_WARMUP", "0") == "1" else None)
 
         self.add_api_route(path="/api/v1/kg",
                            endpoint=self.create_kg,
                            response_model=KnowledgeGraph,
                            methods=["POST"])
 
+        self.add_api_route(path="/api/v1/kg/batch",
+                           endpoint=self.create_kgs,
+                           response_model=List[KnowledgeGraph],
+                           methods=["POST"])
+
+        self.add_api_route(path="/api/v1/kg/stream",
+                           endpoint=self.stream_kgs,
+                           methods=["POST"])
+
+        self.add_api_route(path="/api/v1/kg/sessions/{session_id}",
+                           endpoint=self.update_kg,
+                           response_model=KnowledgeGraph,
+                           methods=["POST"])
+
+        self.add_api_route(path="/api/v1/kg/sessions/{session_id}",
+                           endpoint=self.end_session,
+                           methods=["DELETE"])
+
+        self.add_api_route(path="/api/v1/ready",
+                           endpoint=self.ready,
+                           methods=["GET"])
+
+        self.add_api_route(path="/metrics",
+                           endpoint=self.metrics,
+                           methods=["GET"])
+
         self.add_api_route("/",
                            endpoint=lambda: RedirectResponse(url="/static/index.html"),
                            methods=["GET"])
 
+    async def ready(self) -> JSONResponse:
+        ready = self.kg_construct.is_ready()
+        return JSONResponse({"ready": ready}, status_code=200 if ready else 503)
+
+    async def metrics(self) -> PlainTextResponse:
+        return PlainTextResponse(self.kg_construct.metrics(), media_type="text/plain; version=0.0.4")
+
     async def create_kg(self, text: Text) -> KnowledgeGraph:
         if len(text.content.strip()) == 0:
             return KnowledgeGraph(text.content, [], [], [])
 
-        return self.kg_construct.construct(text.content)
+        return await self.kg_construct.construct_async(text.content, text.decoding)
+
+    async def update_kg(self, session_id: str, text: Text) -> KnowledgeGraph:
+        return await self.kg_construct.construct_incremental_async(session_id, text.content, text.decoding)
+
+    async def end_session(self, session_id: str) -> JSONResponse:
+        self.kg_construct.end_session(session_id)
+        return JSONResponse({"session_id": session_id})
+
+    async def create_kgs(self, texts: List[Text]) -> List[KnowledgeGraph]:
+        kgs = [None] * len(texts)
+        async for i, kg in self._construct_many(texts):
+            kgs[i] = kg
+
+        return kgs
+
+    async def stream_kgs(self, texts: List[Text]) -> StreamingResponse:
+        async def ndjson():
+            async for i, kg in self._construct_many(texts, return_exceptions=True):
+                if isinstance(kg, BaseException):
+                    yield json.dumps({"index": i, "error": str(kg)}) + "\n"
+                else:
+                    yield f"{{\"index\": {i}, \"kg\": {kg.to_json()}}}\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    async def _construct_many(self, texts: List[Text], return_exceptions: bool = False) \
+            -> AsyncIterator[Tuple[int, KnowledgeGraph | BaseException]]:
+        contents = [text.content for text in texts]
+        indices = [i for i, content in enumerate(contents) if len(content.strip()) > 0]
+
+        for i, content in enumerate(contents):
+            if len(content.strip()) == 0:
+                yield i, KnowledgeGraph(content, [], [], [])
+
+        async for j, kg in self.kg_construct.construct_many_async([contents[i] for i in indices], return_exceptions,
+                                                                  [texts[i].decoding for i in indices]):
+            yield indices[j], kg
 
 
 def main():